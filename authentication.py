@@ -1,39 +1,146 @@
 from fastapi import HTTPException, status
 from tortoise.exceptions import DoesNotExist
-from passlib.context import CryptContext
 import jwt
 from dotenv import dotenv_values
 from models import User
 from fastapi import status
 from mail import config_credentials
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from tortoise.signals import post_save, post_delete
+from metrics import span
+import asyncio
+import time
+import os
+
 #logging
 import logging
 
 
 logger = logging.getLogger(__name__)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated = "auto")
+# bcrypt cost factor, every +1 doubles the time of a hash/verify
+BCRYPT_ROUNDS = int(config_credentials.get("BCRYPT_ROUNDS") or 12)
+# "thread" or "process", bcrypt releases the GIL so threads are usually enough
+HASH_POOL = config_credentials.get("HASH_POOL") or "thread"
+HASH_WORKERS = int(config_credentials.get("HASH_WORKERS") or min(4, os.cpu_count() or 1))
+# jobs allowed to wait for a worker before new ones are rejected with 503
+HASH_MAX_PENDING = int(config_credentials.get("HASH_MAX_PENDING") or 64)
+
+# created on the first hash, in whichever thread or process the pool runs it
+_pwd_context = None
+
+
+def pwd_context():
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated = "auto", bcrypt__rounds = BCRYPT_ROUNDS)
+    return _pwd_context
+
+
+def _hash(password):
+    return pwd_context().hash(password)
+
+def _verify(plain_password, hashed_password):
+    return pwd_context().verify(plain_password, hashed_password)
+
+
+class HashingPool:
+    """Runs bcrypt work off the event loop on a bounded worker pool."""
+
+    def __init__(self, kind: str, workers: int, max_pending: int):
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self.active = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor = None
+        self._slots = None
 
-def get_hashed_password(password):
+    def _start(self):
+        if self.kind == "process":
+            self._executor = ProcessPoolExecutor(max_workers = self.workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "bcrypt")
+        self._slots = asyncio.Semaphore(self.workers)
+
+    async def run(self, func, *args):
+        if self._executor is None:
+            self._start()
+
+        # backpressure, shed load instead of letting a login spike queue without bound
+        if self.queued >= self.max_pending:
+            self.rejected += 1
+            logger.warning("Password hashing queue full (%s pending), rejecting request", self.queued)
+            raise HTTPException(
+                status_code = status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail = "Server busy, please retry",
+                headers = {"Retry-After": "1"}
+            )
+
+        self.queued += 1
+        try:
+            with span("bcrypt_queue"):
+                await self._slots.acquire()
+        finally:
+            self.queued -= 1
+
+        self.active += 1
+        try:
+            with span("bcrypt" + func.__name__):
+                return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.active -= 1
+            self.completed += 1
+            self._slots.release()
+
+    def stats(self):
+        return {
+            "pool": self.kind,
+            "workers": self.workers,
+            "active": self.active,
+            "queued": self.queued,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "bcrypt_rounds": BCRYPT_ROUNDS
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait = True)
+            self._executor = None
+
+
+hash_pool = HashingPool(HASH_POOL, HASH_WORKERS, HASH_MAX_PENDING)
+
+
+async def get_hashed_password(password):
     logger.debug("hashing password")
-    return pwd_context.hash(password)
+    return await hash_pool.run(_hash, password)
 
 async def very_token(token: str):
     try:
         logger.info("Verifying token")
         payload = jwt.decode(token, config_credentials["SECRET"], algorithms=["HS256"])
-        logger.debug(f"Token payload: {payload}")
+        logger.debug("Token payload: %s", payload)
         user = await User.get(id=payload.get("id"))
-        logger.info(f"Token valid for user ID {user.id}")
+        logger.info("Token valid for user ID %s", user.id)
     except DoesNotExist:
-        logger.warning(f"User not found for token ID: {payload.get('id')}")
+        logger.warning("User not found for token ID: %s", payload.get('id'))
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User no longer exists"
         )
     except Exception as e:  # This goes LAST
-        logger.error(f"Invalid or expired token: {e}")
+        logger.error("Invalid or expired token: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or expired token",
@@ -43,7 +150,7 @@ async def very_token(token: str):
 async def verify_password(plain_password, hashed_password):
     #LOG verifying password
     logger.info("Verifying user password")
-    result = pwd_context.verify(plain_password, hashed_password)
+    result = await hash_pool.run(_verify, plain_password, hashed_password)
     if result:
         logger.debug("Password verification successful")
     else:
@@ -56,21 +163,111 @@ async def authenticate_user(username, password):
     try:
         user = await User.get(username = username)
     except DoesNotExist:
-        logger.warning(f"Authentication failed user: {username} does not exist")
+        logger.warning("Authentication failed user: %s does not exist", username)
         return False
     
     if user and await verify_password(password, user.password):
-        logger.info(f"Verification of username: {username} successfull")
+        logger.info("Verification of username: %s successfull", username)
         return user
-    logger.warning(f"Authentication failed user: {username}")
+    logger.warning("Authentication failed user: %s", username)
     return False
 
 
+# access token lifetime, cached identities can never outlive the token
+TOKEN_EXPIRE_MINUTES = int(config_credentials.get("TOKEN_EXPIRE_MINUTES") or 60 * 24)
+USER_CACHE_TTL = float(config_credentials.get("USER_CACHE_TTL") or 60)
+USER_CACHE_SIZE = int(config_credentials.get("USER_CACHE_SIZE") or 10000)
+# authorize read-only ownership checks (export, dashboard) from the signed token claims alone,
+# without loading the user. A deleted user keeps that read access until the token expires, writes always load the user
+TRUST_TOKEN_CLAIMS = (config_credentials.get("TRUST_TOKEN_CLAIMS") or "false").lower() in ("1", "true", "yes")
+
+
+class UserCache:
+    """Size bounded LRU of User rows with a per entry TTL."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, id: int):
+        entry = self._entries.get(id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[id]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(id)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, id: int, user: User):
+        self._entries[id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last = False)
+
+    def invalidate(self, id: int):
+        self._entries.pop(id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+user_cache = UserCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+
+
+@post_save(User)
+async def invalidate_cached_user(sender, instance: User, created, using_db, update_fields) -> None:
+    user_cache.invalidate(instance.id)
+
+@post_delete(User)
+async def forget_deleted_user(sender, instance: User, using_db) -> None:
+    user_cache.invalidate(instance.id)
+
+
+@dataclass
+class TokenUser:
+    """Identity taken from verified token claims, enough for ownership checks."""
+    id: int
+    username: str
+
+
+def decode_access_token(token: str) -> dict:
+    # raises jwt.PyJWTError on a bad signature, missing claims or an expired token
+    return jwt.decode(
+        token,
+        config_credentials["SECRET"],
+        algorithms = ["HS256"],
+        options = {"require": ["exp", "iat", "id"]}
+    )
+
+
+async def get_user_by_id(id: int) -> User:
+    user = user_cache.get(id)
+    if user is None:
+        user = await User.get(id = id)
+        user_cache.set(id, user)
+    return user
+
+
 async def token_generator(username: str, password: str):
-    logger.info(f"Generating token for user: {username}")
+    logger.info("Generating token for user: %s", username)
     user = await authenticate_user(username, password)
     if not user:
-        logger.warning(f"Token generation failed for user: {username}")
+        logger.warning("Token generation failed for user: %s", username)
         raise HTTPException(
             status_code = status.HTTP_401_UNAUTHORIZED,
             detail = "Invalid username or password",
@@ -78,13 +275,16 @@ async def token_generator(username: str, password: str):
 
         )
     
+    issued_at = datetime.now(timezone.utc)
     token_data = {
         "id": user.id,
-        "username": user.username
+        "username": user.username,
+        "iat": issued_at,
+        "exp": issued_at + timedelta(minutes = TOKEN_EXPIRE_MINUTES)
     }
 
-    token = jwt.encode(token_data, config_credentials["SECRET"])
-    logger.info(f"Token generated for user: {username}")
+    token = jwt.encode(token_data, config_credentials["SECRET"], algorithm = "HS256")
+    logger.info("Token generated for user: %s", username)
     return token
 
     
\ No newline at end of file
@@ -0,0 +1,306 @@
+"""Latency and throughput benchmark for every API endpoint.
+
+Seeds sellers and products, then drives each endpoint at a fixed concurrency
+and reports p50/p95/p99 latency, throughput and peak RSS. By default the app
+runs in this process against a fresh SQLite file and verification emails go
+to an in-process SMTP stub:
+
+    python benchmarks/api_latency.py --products 1000000 --save benchmarks/baseline.json
+    python benchmarks/api_latency.py --products 1000000 --compare benchmarks/baseline.json
+
+With --url the same scenarios hit a running server instead; point its
+MAIL_SERVER at smtp_stub.py and pass --server-pid to sample its memory.
+Run it from the repository root, the app reads .env from the working directory.
+"""
+from common import summarize, use_database, reset_sqlite, access_token, RSSSampler
+from itertools import count
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+SCENARIOS = (
+    "token",
+    "registration",
+    "product_list",
+    "product_detail",
+    "product_update",
+    "upload_profile",
+    "upload_product",
+)
+PASSWORD = "bench-password"
+SEED_BATCH = 5000
+
+
+async def seed(sellers: int, products: int):
+    """Bulk insert sellers, their businesses and products, skipping the User signals."""
+    from models import User, Business, Product
+    from authentication import get_hashed_password
+    from tortoise import Tortoise
+    from tortoise.transactions import in_transaction
+
+    await Tortoise.generate_schemas(safe = True)
+    if await User.filter(username = "seller0").exists():
+        print("reusing seeded data")
+        return
+
+    password = await get_hashed_password(PASSWORD)
+    started = time.perf_counter()
+    async with in_transaction():
+        await User.bulk_create([
+            User(username = f"seller{n}", email = f"seller{n}@example.com", password = password, is_verified = True)
+            for n in range(sellers)
+        ], batch_size = SEED_BATCH)
+        owners = await User.filter(username__startswith = "seller").order_by("id").values_list("id", flat = True)
+        await Business.bulk_create([
+            Business(business_name = f"seller{n}", owner_id = owner, city = f"city{n % 50}", region = f"region{n % 10}")
+            for n, owner in enumerate(owners)
+        ], batch_size = SEED_BATCH)
+    businesses = await Business.all().order_by("id").values_list("id", flat = True)
+
+    categories = [f"category{n}" for n in range(30)]
+    for start in range(0, products, SEED_BATCH):
+        rows = []
+        for n in range(start, min(start + SEED_BATCH, products)):
+            original = random.randint(10, 1000)
+            new = random.randint(1, original)
+            rows.append(Product(
+                name = f"product{n}",
+                category = categories[n % len(categories)],
+                original_price = original,
+                new_price = new,
+                percentage_discount = (original - new) * 100 // original,
+                business_owner_id = businesses[n % len(businesses)]
+            ))
+        async with in_transaction():
+            await Product.bulk_create(rows)
+    print(f"seeded {sellers} sellers and {products} products in {time.perf_counter() - started:.1f}s")
+
+
+def sample_images(count: int):
+    # distinct noise images, so uploads are not de-duplicated by content hash
+    from PIL import Image
+
+    images = []
+    for n in range(count):
+        buffer = io.BytesIO()
+        Image.frombytes("RGB", (400, 400), os.urandom(400 * 400 * 3)).save(buffer, "PNG")
+        images.append(buffer.getvalue())
+    return images
+
+
+class Workload:
+    """Builds the request for each scenario."""
+
+    def __init__(self, sellers: int, product_ids: list, owned: dict, images: list):
+        self.sellers = sellers
+        self.product_ids = product_ids
+        self.owned = owned
+        self.images = images
+        self.token = access_token(owned["user_id"], owned["username"])
+        self.headers = {"Authorization": "Bearer " + self.token}
+        self.signups = count()
+        self.run_id = os.urandom(3).hex()
+
+    def request(self, scenario: str):
+        if scenario == "token":
+            return "POST", "/token", {"data": {"username": f"seller{random.randrange(self.sellers)}", "password": PASSWORD}}
+        if scenario == "registration":
+            n = next(self.signups)
+            name = f"r{self.run_id}{n}"
+            return "POST", "/registration", {"json": {"username": name, "email": f"{name}@example.com", "password": PASSWORD}}
+        if scenario == "product_list":
+            return "GET", "/product", {"params": {"cursor": random.choice(self.product_ids), "limit": 50}}
+        if scenario == "product_detail":
+            return "GET", f"/product/{random.choice(self.product_ids)}", {}
+        if scenario == "product_update":
+            id, name = random.choice(self.owned["products"])
+            original = random.randint(10, 1000)
+            return "PUT", f"/product/{id}", {"headers": self.headers, "json": {
+                "name": name,
+                "category": "category0",
+                "original_price": str(original),
+                "new_price": str(random.randint(1, original)),
+                "offer_expiration_date": "2030-01-01"
+            }}
+        if scenario == "upload_profile":
+            return "POST", "/uploadfile/profile", {"headers": self.headers, "files": {"file": ("logo.png", random.choice(self.images))}}
+        if scenario == "upload_product":
+            id, _ = random.choice(self.owned["products"])
+            return "POST", f"/uploadfile/product/{id}", {"headers": self.headers, "files": {"file": ("product.png", random.choice(self.images))}}
+        raise ValueError(scenario)
+
+
+async def run_scenario(client, workload: Workload, scenario: str, requests: int, concurrency: int, server_pid: int):
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, url, kwargs = workload.request(scenario)
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    async with RSSSampler(server_pid) as rss:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return summarize(latencies, elapsed, errors, rss.peak)
+
+
+async def load_workload(sellers: int, images: int):
+    from models import User, Product
+
+    products = await Product.all().order_by("id").values_list("id", flat = True)
+    owner = await User.get(username = "seller0")
+    owned = await Product.filter(business_owner__owner__id = owner.id).limit(1000).values_list("id", "name")
+    return Workload(
+        sellers,
+        list(products),
+        {"user_id": owner.id, "username": owner.username, "products": list(owned)},
+        sample_images(images)
+    )
+
+
+async def run(args):
+    import httpx
+
+    results = {}
+    scenarios = args.scenarios or SCENARIOS
+
+    async def drive(client):
+        for scenario in scenarios:
+            # short warm up so pools, caches and lazy imports do not land in the numbers
+            await run_scenario(client, workload, scenario, min(20, args.requests), args.concurrency, args.server_pid)
+            results[scenario] = await run_scenario(client, workload, scenario, args.requests, args.concurrency, args.server_pid)
+            print_row(scenario, results[scenario])
+
+    if args.url:
+        from tortoise import Tortoise
+        import database
+
+        await Tortoise.init(config = database.TORTOISE_ORM)
+        await seed(args.sellers, args.products)
+        workload = await load_workload(args.sellers, args.images)
+        await Tortoise.close_connections()
+        print_header()
+        async with httpx.AsyncClient(base_url = args.url, timeout = 60) as client:
+            await drive(client)
+        return results
+
+    from smtp_stub import SMTPStub
+
+    smtp = SMTPStub(port = 0)
+    await smtp.start()
+
+    import main
+    import mail
+    import images
+    import ratelimit
+
+    # the token and registration scenarios all come from one address
+    ratelimit.rate_limiter.enabled = False
+
+    # keep benchmark uploads out of the real static directory
+    images.IMAGE_DIR = tempfile.mkdtemp(prefix = "ecom_bench_images_")
+
+    # deliver verification mail to the stub instead of the configured relay
+    mail.conf.MAIL_SERVER = smtp.host
+    mail.conf.MAIL_PORT = smtp.port
+    mail.conf.MAIL_STARTTLS = False
+    mail.conf.USE_CREDENTIALS = False
+
+    async with main.app.router.lifespan_context(main.app):
+        await seed(args.sellers, args.products)
+        workload = await load_workload(args.sellers, args.images)
+        print_header()
+        transport = httpx.ASGITransport(app = main.app)
+        async with httpx.AsyncClient(transport = transport, base_url = "http://bench", timeout = 60) as client:
+            await drive(client)
+
+    await smtp.stop()
+    print(f"{len(smtp.messages)} verification emails delivered to the SMTP stub")
+    return results
+
+
+def print_header():
+    print(f"{'endpoint':<16}{'reqs':>7}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rss MB':>9}")
+
+
+def print_row(scenario: str, result: dict):
+    print(f"{scenario:<16}{result['requests']:>7}{result['errors']:>8}{result['throughput']:>10.1f}"
+          f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['peak_rss_mb']:>9.1f}")
+
+
+def compare(results: dict, baseline_path: str):
+    with open(baseline_path) as file:
+        baseline = json.load(file)["results"]
+
+    print(f"\nchange against {baseline_path} (negative latency / positive throughput is better)")
+    print(f"{'endpoint':<16}{'req/s':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'rss':>10}")
+    for scenario, result in results.items():
+        before = baseline.get(scenario)
+        if not before:
+            continue
+
+        def delta(key):
+            return f"{(result[key] - before[key]) / before[key] * 100:+.1f}%" if before[key] else "n/a"
+
+        print(f"{scenario:<16}{delta('throughput'):>10}{delta('p50_ms'):>10}{delta('p95_ms'):>10}"
+              f"{delta('p99_ms'):>10}{delta('peak_rss_mb'):>10}")
+
+
+def save(results: dict, args, path: str):
+    with open(path, "w") as file:
+        json.dump({
+            "settings": {
+                "sellers": args.sellers,
+                "products": args.products,
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "db_url": args.db_url,
+                "url": args.url
+            },
+            "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+            "results": results
+        }, file, indent = 2)
+    print(f"results saved to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--db-url", default = "sqlite:///tmp/ecom_bench.sqlite3")
+    parser.add_argument("--reuse", action = "store_true", help = "keep an already seeded database")
+    parser.add_argument("--sellers", type = int, default = 100)
+    parser.add_argument("--products", type = int, default = 10000)
+    parser.add_argument("--requests", type = int, default = 500, help = "requests per endpoint")
+    parser.add_argument("--concurrency", type = int, default = 16)
+    parser.add_argument("--images", type = int, default = 10, help = "distinct upload images to cycle through")
+    parser.add_argument("--scenarios", nargs = "*", choices = SCENARIOS)
+    parser.add_argument("--url", help = "benchmark a running server instead of the in-process app")
+    parser.add_argument("--server-pid", type = int, help = "sample peak RSS of this process with --url")
+    parser.add_argument("--save", help = "write the results as a JSON baseline")
+    parser.add_argument("--compare", help = "baseline JSON to compare the results against")
+    args = parser.parse_args()
+
+    if not args.reuse:
+        reset_sqlite(args.db_url)
+    use_database(args.db_url)
+
+    results = asyncio.run(run(args))
+    if args.save:
+        save(results, args, args.save)
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,106 @@
+"""Helpers shared by the benchmark scripts."""
+from datetime import datetime, timedelta, timezone
+import asyncio
+import os
+import resource
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed, errors, peak_rss):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_mb": peak_rss / (1024 * 1024),
+    }
+
+
+def use_database(db_url: str):
+    # must run before main is imported, register_tortoise keeps a reference to this dict
+    import database
+
+    database.TORTOISE_ORM.clear()
+    database.TORTOISE_ORM.update(database.build_tortoise_config(db_url))
+
+
+async def migrate(db_url: str):
+    # the schema and its triggers exist before the app starts, as after "python database.py migrate"
+    import database
+    from tortoise import Tortoise
+
+    use_database(db_url)
+    await database.migrate()
+    await Tortoise.close_connections()
+
+
+def reset_sqlite(db_url: str):
+    if not db_url.startswith("sqlite://"):
+        return
+    path = db_url.split("://", 1)[1].split("?", 1)[0]
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def access_token(user_id: int, username: str) -> str:
+    # same claims as authentication.token_generator, without paying for a bcrypt verify
+    import jwt
+    from mail import config_credentials
+
+    issued_at = datetime.now(timezone.utc)
+    return jwt.encode(
+        {"id": user_id, "username": username, "iat": issued_at, "exp": issued_at + timedelta(hours = 6)},
+        config_credentials["SECRET"],
+        algorithm = "HS256"
+    )
+
+
+def current_rss(pid: int = None) -> int:
+    # bytes, from /proc where available, else the peak reported by getrusage
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RSSSampler:
+    """Tracks the peak resident set size of a process while a scenario runs."""
+
+    def __init__(self, pid: int = None, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            self.peak = max(self.peak, current_rss(self.pid))
+            await asyncio.sleep(self.interval)
+
+    async def __aenter__(self):
+        self.peak = current_rss(self.pid)
+        self._task = asyncio.create_task(self._sample())
+        return self
+
+    async def __aexit__(self, *exc):
+        self._task.cancel()
+        self.peak = max(self.peak, current_rss(self.pid))
@@ -0,0 +1,104 @@
+"""JSON encoding of GET /product responses, jsonable_encoder + json against orjson.
+
+Seeds a catalog and builds the payloads GET /product returns (catalog pages,
+?ids= batch details) plus lists of product_pydantic models, then times both
+encoders on each and checks they produce the same JSON:
+
+    python benchmarks/json_encoding.py --sizes 50 500
+
+Finally GET /product is requested through the app with the response cache
+cleared before every request, so each one is built and encoded.
+Run it from the repository root, the app reads .env from the working directory.
+"""
+from common import percentile, use_database, reset_sqlite
+from api_latency import seed
+import argparse
+import asyncio
+import json
+import time
+
+
+def old_encode(content) -> bytes:
+    # the path every endpoint took before encoding.py
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def measure(encode, content, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        encode(content)
+    return (time.perf_counter() - started) / rounds
+
+
+async def build_payloads(size: int) -> dict:
+    from catalog import PRODUCT_FIELDS, filter_products, fetch_page, fetch_product_details
+    from models import Product, product_pydantic
+
+    page, next_cursor = await fetch_page(filter_products(), list(PRODUCT_FIELDS), None, size)
+    details = await fetch_product_details([row["id"] for row in page])
+    models = [await product_pydantic.from_tortoise_orm(product) for product in await Product.all().order_by("id").limit(size)]
+    return {
+        "page": {"status": "ok", "data": page, "next_cursor": next_cursor},
+        "details": {"status": "ok", "data": details},
+        "models": {"status": "ok", "data": models},
+    }
+
+
+async def end_to_end(client, size: int, requests: int):
+    from cache import response_cache
+
+    latencies = []
+    for _ in range(requests):
+        await response_cache.clear()
+        started = time.perf_counter()
+        response = await client.get("/product", params = {"limit": size})
+        latencies.append(time.perf_counter() - started)
+        response.raise_for_status()
+    return latencies
+
+
+async def run(args):
+    use_database(args.db_url)
+
+    import httpx
+    import main
+    from encoding import dumps
+
+    async with main.app.router.lifespan_context(main.app):
+        if not args.reuse:
+            await seed(1, max(args.sizes))
+
+        print(f"{'payload':>16}{'size':>6}{'old ms':>10}{'orjson ms':>11}{'speedup':>9}{'KiB':>8}")
+        for size in args.sizes:
+            for name, content in (await build_payloads(size)).items():
+                old, new = old_encode(content), dumps(content)
+                if json.loads(old) != json.loads(new):
+                    raise SystemExit(f"{name} at size {size}: the encoders disagree")
+                old_time = measure(old_encode, content, args.rounds)
+                new_time = measure(dumps, content, args.rounds)
+                print(f"{name:>16}{size:>6}{old_time * 1000:>10.3f}{new_time * 1000:>11.3f}"
+                      f"{old_time / new_time:>8.1f}x{len(new) / 1024:>8.1f}")
+
+        async with httpx.AsyncClient(transport = httpx.ASGITransport(app = main.app), base_url = "http://bench") as client:
+            print()
+            print(f"GET /product, response cache cleared before each of {args.requests} requests")
+            for size in args.sizes:
+                latencies = await end_to_end(client, size, args.requests)
+                print(f"limit={size:<5} p50 {percentile(latencies, 50) * 1000:.2f} ms  p99 {percentile(latencies, 99) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--db-url", default = "sqlite:///tmp/ecom_bench_json.sqlite3")
+    parser.add_argument("--reuse", action = "store_true", help = "keep an already seeded database")
+    parser.add_argument("--sizes", type = int, nargs = "*", default = [50, 500])
+    parser.add_argument("--rounds", type = int, default = 200, help = "encodings timed per payload")
+    parser.add_argument("--requests", type = int, default = 200, help = "end-to-end requests per size")
+    args = parser.parse_args()
+
+    if not args.reuse:
+        reset_sqlite(args.db_url)
+    asyncio.run(run(args))
@@ -0,0 +1,108 @@
+"""Deals queries from the in-memory price index against the same queries in SQL.
+
+Seeds a catalog, loads the index and times top-N by discount and price range
+queries both ways, checking they return the same products in the same order:
+
+    python benchmarks/price_index.py --products 1000000
+
+Then updates ``--updates`` products and times the refresh that applies them.
+Only the ids are compared and timed, GET /product/deals reads the returned
+rows from the database either way. Run it from the repository root, the app
+reads .env from the working directory.
+"""
+from common import percentile, use_database, reset_sqlite, migrate
+from api_latency import seed
+from decimal import Decimal
+import argparse
+import asyncio
+import random
+import time
+
+CASES = [
+    ("top discounts", dict(category = None, min_price = None, max_price = None, min_discount = None, sort = "discount")),
+    ("category top discounts", dict(category = "category7", min_price = None, max_price = None, min_discount = None, sort = "discount")),
+    ("price range by discount", dict(category = None, min_price = Decimal(100), max_price = Decimal(250), min_discount = None, sort = "discount")),
+    ("category range by discount", dict(category = "category7", min_price = Decimal(100), max_price = Decimal(250), min_discount = 30, sort = "discount")),
+    ("cheapest", dict(category = None, min_price = None, max_price = None, min_discount = None, sort = "price")),
+    ("category cheapest over 50", dict(category = "category7", min_price = Decimal(50), max_price = None, min_discount = 10, sort = "price")),
+]
+
+
+async def sql_ids(case: dict, limit: int) -> list:
+    # the fallback of price_index.find_deals, ids only
+    from tortoise.expressions import RawSQL
+    from catalog import filter_products
+
+    queryset = filter_products(case["category"], case["min_price"], case["max_price"], case["min_discount"])
+    if case["sort"] == "discount":
+        queryset = queryset.order_by("-percentage_discount", "id")
+    else:
+        queryset = queryset.annotate(price_order = RawSQL('CAST("new_price" AS DOUBLE PRECISION)')).order_by("price_order", "id")
+    return list(await queryset.limit(limit).values_list("id", flat = True))
+
+
+async def run(args):
+    use_database(args.db_url)
+
+    import main
+    from models import Product
+    from price_index import price_index
+
+    async with main.app.router.lifespan_context(main.app):
+        # driven by hand below instead of by its background task
+        await price_index.stop()
+        if not args.reuse:
+            await seed(1, args.products)
+
+        started = time.perf_counter()
+        await price_index.load()
+        stats = price_index.stats()
+        print(f"loaded {stats['products']} products in {stats['categories']} categories in "
+              f"{(time.perf_counter() - started) * 1000:.0f} ms, {stats['bytes'] / 1024 / 1024:.1f} MiB, "
+              f"{stats['bytes'] / max(stats['products'], 1):.0f} bytes per product")
+
+        print()
+        print(f"{'query':<30}{'index p50 ms':>14}{'index p99 ms':>14}{'sql p50 ms':>12}{'speedup':>9}")
+        for name, case in CASES:
+            expected = await sql_ids(case, args.limit)
+            if price_index.query(limit = args.limit, **case) != expected:
+                raise SystemExit(f"{name}: the index and SQL disagree")
+
+            index_times = []
+            for _ in range(args.rounds):
+                started = time.perf_counter()
+                price_index.query(limit = args.limit, **case)
+                index_times.append(time.perf_counter() - started)
+            sql_times = []
+            for _ in range(max(args.rounds // 20, 3)):
+                started = time.perf_counter()
+                await sql_ids(case, args.limit)
+                sql_times.append(time.perf_counter() - started)
+
+            index_p50, sql_p50 = percentile(index_times, 50), percentile(sql_times, 50)
+            print(f"{name:<30}{index_p50 * 1000:>14.3f}{percentile(index_times, 99) * 1000:>14.3f}"
+                  f"{sql_p50 * 1000:>12.2f}{sql_p50 / index_p50:>8.0f}x")
+
+        ids = await Product.all().limit(args.updates * 10).values_list("id", flat = True)
+        for id in random.sample(ids, min(args.updates, len(ids))):
+            await Product.filter(id = id).update(new_price = random.randint(1, 10), percentage_discount = random.randint(0, 99))
+        applied = await price_index.refresh()
+        print()
+        print(f"refresh applied {applied} changes in {price_index.last_refresh_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--db-url", default = "sqlite:///tmp/ecom_bench_price_index.sqlite3")
+    parser.add_argument("--reuse", action = "store_true", help = "keep an already seeded database")
+    parser.add_argument("--products", type = int, default = 100000)
+    parser.add_argument("--limit", type = int, default = 20)
+    parser.add_argument("--rounds", type = int, default = 1000, help = "index queries timed per case")
+    parser.add_argument("--updates", type = int, default = 100, help = "products changed before the timed refresh")
+    args = parser.parse_args()
+
+    if not args.reuse:
+        reset_sqlite(args.db_url)
+    # the refresh is measured through the change feed triggers
+    asyncio.run(migrate(args.db_url))
+    asyncio.run(run(args))
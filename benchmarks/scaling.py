@@ -0,0 +1,183 @@
+"""Throughput of serve.py as the number of worker processes grows.
+
+Seeds a catalog, then for each worker count starts serve.py on it, drives one
+endpoint from several client processes and reports requests per second,
+speedup and per-worker efficiency against a single worker:
+
+    python benchmarks/scaling.py --workers 1 2 4 8 --scenario product_list
+
+Throughput should grow close to linearly up to the number of cores. The load
+generator runs on the same machine by default and takes cores of its own, for
+clean numbers give it its own host: start serve.py there and pass --url.
+Run it from the repository root, the app reads .env from the working directory.
+"""
+from common import percentile, use_database, reset_sqlite, ROOT
+from api_latency import seed, load_workload
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+SCENARIOS = ("product_list", "product_detail", "token")
+
+
+def default_worker_counts():
+    cores = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+
+async def drive(url: str, workload, scenario: str, requests: int, concurrency: int, start_at: float):
+    import httpx
+
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker(client):
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, path, kwargs = workload.request(scenario)
+            started = time.perf_counter()
+            response = await client.request(method, path, **kwargs)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    limits = httpx.Limits(max_connections = concurrency)
+    async with httpx.AsyncClient(base_url = url, timeout = 60, limits = limits) as client:
+        # every client process starts at the same moment
+        await asyncio.sleep(max(0, start_at - time.time()))
+        started = time.time()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return latencies, errors, started, time.time()
+
+
+def client_process(results, url, workload, scenario, requests, concurrency, start_at):
+    results.put(asyncio.run(drive(url, workload, scenario, requests, concurrency, start_at)))
+
+
+def run_load(url: str, workload, args) -> dict:
+    # clients are forked so the workload is shared without pickling
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    start_at = time.time() + 1
+    processes = [
+        context.Process(target = client_process, args = (
+            results, url, workload, args.scenario,
+            args.requests // args.clients, max(1, args.concurrency // args.clients), start_at
+        ))
+        for _ in range(args.clients)
+    ]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    latencies = [latency for outcome in outcomes for latency in outcome[0]]
+    elapsed = max(outcome[3] for outcome in outcomes) - min(outcome[2] for outcome in outcomes)
+    return {
+        "requests": len(latencies),
+        "errors": sum(outcome[1] for outcome in outcomes),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def start_server(workers: int, args) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, "serve.py", "--workers", str(workers), "--port", str(args.port), "--db-url", args.db_url,
+         "--log-level", "warning"],
+        cwd = ROOT,
+        stdout = subprocess.DEVNULL
+    )
+    import httpx
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{args.port}/", timeout = 1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("serve.py did not start within 60s")
+
+
+def stop_server(server: subprocess.Popen):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout = 60)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+async def prepare(args):
+    from tortoise import Tortoise
+    import database
+
+    await Tortoise.init(config = database.TORTOISE_ORM)
+    await seed(args.sellers, args.products)
+    workload = await load_workload(args.sellers, 0)
+    await Tortoise.close_connections()
+    return workload
+
+
+def print_row(workers, result, single):
+    speedup = result["throughput"] / single if single else 0.0
+    print(f"{workers:>8}{result['requests']:>8}{result['errors']:>8}{result['throughput']:>10.1f}"
+          f"{speedup:>9.2f}x{speedup / workers * 100:>10.0f}%{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--db-url", default = "sqlite:///tmp/ecom_bench_scaling.sqlite3")
+    parser.add_argument("--reuse", action = "store_true", help = "keep an already seeded database")
+    parser.add_argument("--sellers", type = int, default = 100)
+    parser.add_argument("--products", type = int, default = 10000)
+    parser.add_argument("--workers", type = int, nargs = "*", default = default_worker_counts())
+    parser.add_argument("--scenario", choices = SCENARIOS, default = "product_list")
+    parser.add_argument("--requests", type = int, default = 5000, help = "requests per worker count")
+    parser.add_argument("--concurrency", type = int, default = 64)
+    parser.add_argument("--clients", type = int, default = max(1, (os.cpu_count() or 1) // 2), help = "load generator processes")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--url", help = "measure an already running server instead of starting serve.py")
+    parser.add_argument("--save", help = "write the results as JSON")
+    args = parser.parse_args()
+
+    if not args.reuse:
+        reset_sqlite(args.db_url)
+    use_database(args.db_url)
+    workload = asyncio.run(prepare(args))
+
+    print(f"{args.scenario}, {args.requests} requests at concurrency {args.concurrency} from {args.clients} client(s)")
+    print(f"{'workers':>8}{'reqs':>8}{'errors':>8}{'req/s':>10}{'speedup':>10}{'efficiency':>11}{'p50 ms':>10}{'p99 ms':>10}")
+    results = {}
+    for workers in ([0] if args.url else args.workers):
+        server = None if args.url else start_server(workers, args)
+        url = args.url or f"http://127.0.0.1:{args.port}"
+        try:
+            # warm the caches and connections of every worker before measuring
+            run_load(url, workload, argparse.Namespace(**{**vars(args), "requests": min(500, args.requests)}))
+            results[workers] = run_load(url, workload, args)
+        finally:
+            if server is not None:
+                stop_server(server)
+        print_row(max(workers, 1), results[workers], results[min(results)]["throughput"])
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"scenario": args.scenario, "cpus": os.cpu_count(), "results": results}, file, indent = 2)
+        print(f"results saved to {args.save}")
@@ -0,0 +1,136 @@
+"""Cold start report: import cost per module and the time of each startup phase.
+
+Every run is a fresh interpreter, as a restarted container or a new worker
+would be. It times importing main, each startup step (the ORM init, then the
+app's own startup handlers) and the first request, and lists the modules
+that dominate the import according to python -X importtime:
+
+    python benchmarks/startup.py                      # exit 1 when readiness exceeds 1000 ms, for CI
+    python benchmarks/startup.py --budget-ms 0        # report only
+    python benchmarks/startup.py --save startup.json
+
+Readiness is import plus startup plus the first request. Run it from the
+repository root, the app reads .env from the working directory.
+"""
+from common import use_database, reset_sqlite, migrate, ROOT
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+# a restarted worker should be serving within a second
+STARTUP_BUDGET_MS = 1000
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+\d+ \| \s*(\S+)")
+
+
+async def measure_phases(db_url: str) -> dict:
+    """Runs in the child: phase name -> milliseconds."""
+    phases = {}
+    started = time.perf_counter()
+    use_database(db_url)
+    import main
+    phases["import main"] = (time.perf_counter() - started) * 1000
+
+    # time each startup handler separately, what is left of the lifespan is the ORM init
+    def timed(handler):
+        async def run():
+            handler_started = time.perf_counter()
+            await handler()
+            phases[f"startup: {handler.__name__}"] = (time.perf_counter() - handler_started) * 1000
+        return run
+
+    main.app.router.on_startup = [timed(handler) for handler in main.app.router.on_startup]
+
+    import httpx
+
+    lifespan_started = time.perf_counter()
+    async with main.app.router.lifespan_context(main.app):
+        lifespan = (time.perf_counter() - lifespan_started) * 1000
+        phases["startup: orm"] = lifespan - sum(value for name, value in phases.items() if name.startswith("startup"))
+
+        async with httpx.AsyncClient(transport = httpx.ASGITransport(app = main.app), base_url = "http://bench") as client:
+            request_started = time.perf_counter()
+            response = await client.get("/product", params = {"limit": 1})
+            response.raise_for_status()
+            phases["first request"] = (time.perf_counter() - request_started) * 1000
+        phases["ready"] = (time.perf_counter() - started) * 1000
+    return phases
+
+
+def run_child(db_url: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", "--db-url", db_url],
+        cwd = ROOT, capture_output = True, text = True, check = True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_profile(top: int) -> list:
+    """(package, modules, ms) of the packages whose own module code takes longest while main is imported."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd = ROOT, capture_output = True, text = True, check = True
+    ).stderr
+    self_time = {}
+    modules = {}
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        # self time only, the cumulative column would count nested packages twice
+        own, module = int(match[1]), match[2]
+        package = module.split(".")[0]
+        self_time[package] = self_time.get(package, 0) + own
+        modules[package] = modules.get(package, 0) + 1
+    ranked = sorted(self_time, key = self_time.get, reverse = True)[:top]
+    return [(package, modules[package], self_time[package] / 1000) for package in ranked]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--db-url", default = "sqlite:///tmp/ecom_bench_startup.sqlite3")
+    parser.add_argument("--runs", type = int, default = 5, help = "fresh interpreters, the median is reported")
+    parser.add_argument("--top", type = int, default = 15, help = "packages listed in the import profile")
+    parser.add_argument("--budget-ms", type = float, default = STARTUP_BUDGET_MS,
+                        help = "fail when the median readiness exceeds this, 0 to only report")
+    parser.add_argument("--save", help = "write the results as JSON")
+    parser.add_argument("--child", action = "store_true", help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(measure_phases(args.db_url))))
+        sys.exit(0)
+
+    reset_sqlite(args.db_url)
+    asyncio.run(migrate(args.db_url))
+
+    runs = [run_child(args.db_url) for _ in range(args.runs)]
+    phases = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+    print(f"median of {args.runs} fresh processes")
+    print(f"{'phase':<36}{'ms':>10}")
+    for name, value in phases.items():
+        print(f"{name:<36}{value:>10.1f}")
+
+    profile = import_profile(args.top)
+    print()
+    print(f"{'package':<36}{'modules':>10}{'ms':>10}")
+    for package, count, own in profile:
+        print(f"{package:<36}{count:>10}{own:>10.1f}")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({
+                "python": sys.version.split()[0],
+                "phases": phases,
+                "imports": [{"package": package, "modules": count, "ms": own} for package, count, own in profile]
+            }, file, indent = 2)
+        print(f"results saved to {args.save}")
+
+    if args.budget_ms and phases["ready"] > args.budget_ms:
+        print(f"ready after {phases['ready']:.0f} ms, over the {args.budget_ms:.0f} ms budget")
+        sys.exit(1)
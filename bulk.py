@@ -0,0 +1,228 @@
+from fastapi import HTTPException, status
+from pydantic import ValidationError
+from tortoise.exceptions import IntegrityError
+from tortoise.transactions import in_transaction
+from typing import AsyncIterator, List, Optional, Tuple
+from decimal import Decimal
+from catalog import PRODUCT_FIELDS, iter_product_chunks
+from expiry import offer_active
+from models import Product, product_pydanticIn
+import codecs
+import csv
+import io
+import orjson
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+# rows validated, inserted and committed together
+BULK_CHUNK_SIZE = 1000
+# per-row errors returned in the response, the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+IMPORT_FIELDS = list(product_pydanticIn.model_fields)
+CENT = Decimal("0.01")
+FORMATS = ("csv", "ndjson")
+
+
+def detect_format(format: Optional[str], content_type: Optional[str]) -> str:
+    if format is None:
+        format = "csv" if content_type and "csv" in content_type else "ndjson"
+    if format not in FORMATS:
+        raise HTTPException(
+            status_code = status.HTTP_400_BAD_REQUEST,
+            detail = f"format must be one of {', '.join(FORMATS)}"
+        )
+    return format
+
+
+async def iter_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # decode the body as it arrives, never holding more than one partial line
+    decoder = codecs.getincrementaldecoder("utf-8")(errors = "replace")
+    pending = ""
+    async for chunk in stream:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final = True)
+    if pending:
+        yield pending
+
+
+async def parse_rows(stream: AsyncIterator[bytes], format: str) -> AsyncIterator[Tuple[int, object]]:
+    """Yield (row number, dict) per record, or (row number, error message) for unparsable ones."""
+    number = 0
+    if format == "ndjson":
+        async for line in iter_lines(stream):
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                row = orjson.loads(line)
+                yield number, row if isinstance(row, dict) else "Row must be a JSON object"
+            except ValueError as e:
+                yield number, f"Invalid JSON: {e}"
+        return
+
+    header = None
+    record = ""
+    async for line in iter_lines(stream):
+        record += line
+        # a quoted field may span lines, wait for its closing quote
+        if record.count('"') % 2:
+            continue
+        values = next(csv.reader([record]), [])
+        record = ""
+        if not any(value.strip() for value in values):
+            continue
+        if header is None:
+            header = [value.strip() for value in values]
+            continue
+        number += 1
+        if len(values) != len(header):
+            yield number, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        # empty cells fall back to the model defaults
+        yield number, {key: value for key, value in zip(header, values) if value != ""}
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, row: int, detail):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "errors": detail})
+
+    def as_dict(self):
+        return {
+            "status": "ok" if not self.failed else "partial",
+            "created": self.created,
+            "failed": self.failed,
+            "errors": self.errors
+        }
+
+
+def _validate(chunk: List[Tuple[int, object]], report: ImportReport) -> List[Tuple[int, dict]]:
+    valid = []
+    seen = set()
+    for number, raw in chunk:
+        if isinstance(raw, str):
+            report.error(number, [raw])
+            continue
+        try:
+            product = product_pydanticIn.model_validate({key: raw[key] for key in IMPORT_FIELDS if key in raw})
+        except ValidationError as e:
+            report.error(number, [f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()])
+            continue
+
+        product = product.model_dump(exclude_unset = True)
+        if product["original_price"] <= 0:
+            report.error(number, ["original_price: must be greater than 0"])
+            continue
+        # the columns hold cents, which also keeps the discount below exact in integers
+        fractional = [field for field in ("original_price", "new_price") if product[field] != product[field].quantize(CENT)]
+        if fractional:
+            report.error(number, [f"{field}: at most 2 decimal places" for field in fractional])
+            continue
+        if product["name"] in seen:
+            report.error(number, ["name: duplicated earlier in the upload"])
+            continue
+        seen.add(product["name"])
+        valid.append((number, product))
+    return valid
+
+
+async def _insert_chunk(chunk: List[Tuple[int, object]], business_id: int, report: ImportReport):
+    valid = _validate(chunk, report)
+    if not valid:
+        return
+
+    existing = set(await Product.filter(name__in = [product["name"] for _, product in valid]).values_list("name", flat = True))
+    rows = []
+    for number, product in valid:
+        if product["name"] in existing:
+            report.error(number, ["name: a product with this name already exists"])
+        else:
+            rows.append((number, product))
+    if not rows:
+        return
+
+    # add_new_product stores int((original - new) / original * 100), computed for the whole
+    # chunk at once in integer cents so it truncates the same way (towards zero).
+    # numpy is imported here, most processes never import a file
+    import numpy as np
+
+    original = np.array([int(product["original_price"] * 100) for _, product in rows], dtype = np.int64)
+    new = np.array([int(product["new_price"] * 100) for _, product in rows], dtype = np.int64)
+    difference = (original - new) * 100
+    discounts = np.sign(difference) * (np.abs(difference) // original)
+
+    objects = [
+        Product(
+            **product,
+            percentage_discount = int(discount),
+            active = offer_active(product.get("offer_expiration_date")),
+            business_owner_id = business_id
+        )
+        for (_, product), discount in zip(rows, discounts)
+    ]
+    try:
+        async with in_transaction():
+            await Product.bulk_create(objects)
+        report.created += len(objects)
+    except IntegrityError:
+        # a concurrent writer took one of the names, insert row by row to find it
+        for (number, product), discount in zip(rows, discounts):
+            try:
+                await Product.create(
+                    **product,
+                    percentage_discount = int(discount),
+                    active = offer_active(product.get("offer_expiration_date")),
+                    business_owner_id = business_id
+                )
+                report.created += 1
+            except IntegrityError as e:
+                report.error(number, [str(e)])
+
+
+async def import_products(rows: AsyncIterator[Tuple[int, object]], business_id: int, on_chunk = None) -> dict:
+    report = ImportReport()
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            await _insert_chunk(chunk, business_id, report)
+            chunk = []
+            if on_chunk is not None:
+                await on_chunk()
+    if chunk:
+        await _insert_chunk(chunk, business_id, report)
+        if on_chunk is not None:
+            await on_chunk()
+
+    logger.info("Bulk import for business %s: %s created, %s failed", business_id, report.created, report.failed)
+    return report.as_dict()
+
+
+async def export_products(queryset, format: str) -> AsyncIterator[bytes]:
+    fields = list(PRODUCT_FIELDS)
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames = fields, lineterminator = "\n")
+        writer.writeheader()
+        yield buffer.getvalue().encode()
+
+    async for rows in iter_product_chunks(queryset, fields):
+        if format == "csv":
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames = fields, lineterminator = "\n")
+            writer.writerows(rows)
+            yield buffer.getvalue().encode()
+        else:
+            yield b"".join(orjson.dumps(row) + b"\n" for row in rows)
@@ -0,0 +1,351 @@
+from fastapi import Request, Response, status
+from tortoise import connections
+from tortoise.transactions import in_transaction
+from tortoise.queryset import QuerySet
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from dotenv import dotenv_values
+from typing import Awaitable, Callable, Iterable, Optional
+from encoding import dumps
+from models import ResponseCacheEntry, ResponseCacheEntryTag, ResponseCacheTag
+import hashlib
+import importlib
+import time
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+config_credentials = dotenv_values(".env")
+
+# total size of cached response bodies per worker
+RESPONSE_CACHE_BYTES = int(config_credentials.get("RESPONSE_CACHE_BYTES") or 64 * 1024 * 1024)
+# seconds an entry is served at most, a bound on staleness should an invalidation be missed
+RESPONSE_CACHE_TTL = float(config_credentials.get("RESPONSE_CACHE_TTL") or 300)
+# "memory", "database" for the cache shared by every worker, or "package.module:ClassName" of a CacheBackend
+RESPONSE_CACHE_BACKEND = config_credentials.get("RESPONSE_CACHE_BACKEND") or "memory"
+INVALIDATION_HISTORY = 10000
+
+
+@dataclass
+class CacheEntry:
+    body: bytes
+    etag: str
+
+
+class CacheBackend(ABC):
+    """Interface for response cache stores.
+
+    Entries carry tags (e.g. "product:12", "business:3", "catalog") and are
+    dropped by tag when the rows behind them change. ``set`` is given the
+    generation read before the response was built and must refuse the entry
+    if one of its tags was invalidated since, so a slow read cannot cache
+    data that a concurrent write already replaced. ``shared`` backends are
+    seen by every worker, which then need not invalidate for each other.
+    """
+
+    shared = False
+
+    @abstractmethod
+    async def generation(self) -> int:
+        ...
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, entry: CacheEntry, tags: Iterable[str], since: int):
+        ...
+
+    @abstractmethod
+    async def invalidate(self, tags: Iterable[str]):
+        ...
+
+    @abstractmethod
+    async def clear(self):
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryCache(CacheBackend):
+    """In-process LRU bounded by the total size of the cached bodies and the age of each entry.
+
+    Every worker has its own, changes.ChangeFeed invalidates it for writes made by the others.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._generation = 0
+        self._entries = OrderedDict()   # key -> (entry, tags, expires)
+        self._tags = {}                 # tag -> set of keys
+        self._invalidated_at = OrderedDict()    # tag -> generation of its last invalidation, oldest first
+        # generation of the newest record dropped from _invalidated_at, reads older than it are not cached
+        self._forgotten = -1
+
+    async def generation(self) -> int:
+        return self._generation
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        item = self._entries.get(key)
+        if item is not None and item[2] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            item = None
+        if item is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    async def set(self, key: str, entry: CacheEntry, tags: Iterable[str], since: int):
+        tags = set(tags)
+        if since <= self._forgotten or any(self._invalidated_at.get(tag, -1) >= since for tag in tags):
+            return
+        if len(entry.body) > self.max_bytes:
+            return
+
+        self._remove(key)
+        self._entries[key] = (entry, tags, time.monotonic() + self.ttl)
+        self.size += len(entry.body)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+        while self.size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    async def invalidate(self, tags: Iterable[str]):
+        for tag in tags:
+            self._invalidated_at.pop(tag, None)
+            self._invalidated_at[tag] = self._generation
+            for key in list(self._tags.pop(tag, ())):
+                self._remove(key)
+                self.invalidations += 1
+        self._generation += 1
+
+        # only reads still in flight need the history, keep it bounded
+        while len(self._invalidated_at) > INVALIDATION_HISTORY:
+            _, self._forgotten = self._invalidated_at.popitem(last = False)
+
+    async def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+        self.size = 0
+        # reads in flight must not cache what they read before the clear
+        self._forgotten = self._generation
+        self._generation += 1
+
+    def _remove(self, key: str):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        entry, tags, _ = item
+        self.size -= len(entry.body)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
+
+
+# the empty tag is never used by an entry, its row counts the invalidations
+GENERATION_COUNTER = """INSERT INTO response_cache_tag (tag, generation) VALUES ('', 1)
+    ON CONFLICT (tag) DO UPDATE SET generation = response_cache_tag.generation + 1 RETURNING generation"""
+# set holds these until it commits, an invalidation of the same tags waits for it and then drops the entry
+POSTGRES_LOCK_TAGS = "SELECT generation FROM response_cache_tag WHERE tag = ANY($1::text[]) ORDER BY tag FOR SHARE"
+SQLITE_LOCK_TAGS = "SELECT generation FROM response_cache_tag WHERE tag IN ({})"
+
+
+class DatabaseCache(CacheBackend):
+    """Entries in tables of the application database, one cache for every worker.
+
+    A hit costs a query by primary key instead of a dict lookup, in exchange a
+    write is invalidated once for all workers and a response is built once.
+    Invalidations take their generation from a counter row, so they are
+    ordered across workers. Expired entries are deleted by ``set`` about once
+    per ``ttl``, entries are not bounded by size.
+    """
+
+    shared = True
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.refused = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._next_prune = 0.0
+
+    async def generation(self) -> int:
+        counter = await ResponseCacheTag.filter(tag = "").values_list("generation", flat = True)
+        # invalidations still running take this value or a later one, and are not missed
+        return (counter[0] if counter else 0) + 1
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        rows = await ResponseCacheEntry.filter(key = _digest(key), expires_at__gt = time.time()).values_list("body", "etag")
+        if not rows:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CacheEntry(bytes(rows[0][0]), rows[0][1])
+
+    async def set(self, key: str, entry: CacheEntry, tags: Iterable[str], since: int):
+        tags = sorted(set(tags))
+        # "*" is invalidated by clear
+        checked = sorted(tags + ["*"])
+        digest = _digest(key)
+        now = time.time()
+        async with in_transaction() as connection:
+            # rows to lock, on SQLite this write also takes the database lock until commit
+            await ResponseCacheTag.bulk_create([ResponseCacheTag(tag = tag, generation = 0) for tag in checked],
+                                               ignore_conflicts = True, using_db = connection)
+            if connections.get("default").capabilities.dialect == "postgres":
+                _, rows = await connection.execute_query(POSTGRES_LOCK_TAGS, [checked])
+            else:
+                _, rows = await connection.execute_query(SQLITE_LOCK_TAGS.format(", ".join("?" * len(checked))), checked)
+            if any(row["generation"] >= since for row in rows):
+                self.refused += 1
+                return
+
+            await ResponseCacheEntryTag.filter(key = digest).using_db(connection).delete()
+            await ResponseCacheEntry.bulk_create(
+                [ResponseCacheEntry(key = digest, body = entry.body, etag = entry.etag, expires_at = now + self.ttl)],
+                on_conflict = ["key"], update_fields = ["body", "etag", "expires_at"], using_db = connection
+            )
+            await ResponseCacheEntryTag.bulk_create([ResponseCacheEntryTag(key = digest, tag = tag) for tag in tags],
+                                                    using_db = connection)
+        self.sets += 1
+
+        if now >= self._next_prune:
+            self._next_prune = now + self.ttl
+            self.expirations += await self._delete(ResponseCacheEntry.filter(expires_at__lte = now))
+
+    async def invalidate(self, tags: Iterable[str]):
+        tags = sorted(set(tags))
+        self.invalidations += await self._delete(ResponseCacheEntryTag.filter(tag__in = tags), tags)
+
+    async def clear(self):
+        await self._delete(ResponseCacheEntry.all(), ["*"])
+
+    async def _delete(self, queryset: QuerySet, tags: Iterable[str] = ()) -> int:
+        """Delete the entries whose keys ``queryset`` selects, after bumping the generation of ``tags``."""
+        async with in_transaction() as connection:
+            if tags:
+                _, rows = await connection.execute_query(GENERATION_COUNTER)
+                await ResponseCacheTag.bulk_create([ResponseCacheTag(tag = tag, generation = rows[0]["generation"]) for tag in tags],
+                                                   on_conflict = ["tag"], update_fields = ["generation"], using_db = connection)
+            keys = list(set(await queryset.using_db(connection).values_list("key", flat = True)))
+            if keys:
+                await ResponseCacheEntryTag.filter(key__in = keys).using_db(connection).delete()
+                await ResponseCacheEntry.filter(key__in = keys).using_db(connection).delete()
+        return len(keys)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "database",
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "sets": self.sets,
+            "refused": self.refused,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
+
+
+def _digest(key: str) -> str:
+    return hashlib.blake2b(key.encode(), digest_size = 16).hexdigest()
+
+
+def load_backend(name: str) -> CacheBackend:
+    if name == "memory":
+        return MemoryCache(RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL)
+    if name == "database":
+        return DatabaseCache(RESPONSE_CACHE_TTL)
+    module, _, cls = name.partition(":")
+    logger.info("Using response cache backend %s", name)
+    backend = getattr(importlib.import_module(module), cls)()
+    # fail at startup, not on the first request
+    if not isinstance(backend, CacheBackend):
+        raise TypeError(f"RESPONSE_CACHE_BACKEND {name!r} is not a CacheBackend")
+    return backend
+
+
+response_cache = load_backend(RESPONSE_CACHE_BACKEND)
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size = 16).hexdigest() + '"'
+
+
+async def cached_json(
+    request: Request,
+    key: str,
+    build: Callable[[], Awaitable[dict]],
+    tags: Callable[[dict], Iterable[str]]
+) -> Response:
+    """Serve the JSON built by ``build`` from the cache, answering If-None-Match with 304.
+
+    ``tags`` maps the built content to the tags it is invalidated by.
+    """
+    entry = await response_cache.get(key)
+    if entry is None:
+        since = await response_cache.generation()
+        content = await build()
+        body = dumps(content)
+        entry = CacheEntry(body, make_etag(body))
+        await response_cache.set(key, entry, tags(content), since)
+
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == entry.etag:
+        return Response(status_code = status.HTTP_304_NOT_MODIFIED, headers = headers)
+    return Response(entry.body, media_type = "application/json", headers = headers)
+
+
+async def invalidate_product(id: Optional[int] = None):
+    # every catalog page may gain, lose or reorder rows on any product write
+    tags = ["catalog"]
+    if id is not None:
+        tags.append(f"product:{id}")
+    await response_cache.invalidate(tags)
+
+
+async def invalidate_products(ids: Iterable[int]):
+    # status changes made in bulk (offer expiry), search hides inactive products as well
+    await response_cache.invalidate(["catalog", "search"] + [f"product:{id}" for id in ids])
+
+
+async def invalidate_business(id: int):
+    # product details embed the seller's business row, search matches its description
+    await response_cache.invalidate([f"business:{id}", "search"])
@@ -0,0 +1,190 @@
+from fastapi import HTTPException, status
+from tortoise.queryset import QuerySet
+from tortoise.expressions import RawSQL
+from decimal import Decimal
+from datetime import date, datetime
+from typing import AsyncIterator, List, Optional
+from models import Product
+import orjson
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+# columns exposed by product_pydantic, in the same order
+PRODUCT_FIELDS = (
+    "id",
+    "name",
+    "category",
+    "original_price",
+    "new_price",
+    "percentage_discount",
+    "offer_expiration_date",
+    "active",
+    "product_image",
+)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# rows fetched per query while streaming, keeps memory flat for any catalog size
+STREAM_CHUNK_SIZE = 500
+
+
+def parse_fields(fields: Optional[str]) -> List[str]:
+    # sparse field selection, "id" is always returned because it is the cursor
+    if not fields:
+        return list(PRODUCT_FIELDS)
+
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in PRODUCT_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code = status.HTTP_400_BAD_REQUEST,
+            detail = f"Unknown product fields: {', '.join(unknown)}"
+        )
+
+    return ["id"] + [field for field in PRODUCT_FIELDS if field in requested and field != "id"]
+
+
+def filter_products(
+    category: Optional[str] = None,
+    min_price: Optional[Decimal] = None,
+    max_price: Optional[Decimal] = None,
+    min_discount: Optional[int] = None,
+    max_discount: Optional[int] = None,
+    active: Optional[bool] = True
+) -> QuerySet:
+    # expired offers are hidden unless active is None
+    queryset = Product.all() if active is None else Product.filter(active = active)
+    if category is not None:
+        queryset = queryset.filter(category = category)
+    # price filters apply to the price the buyer actually pays. DecimalField is stored
+    # as text on SQLite, so compare numerically instead of lexicographically
+    if min_price is not None or max_price is not None:
+        queryset = queryset.annotate(price_value = RawSQL('CAST("new_price" AS DOUBLE PRECISION)'))
+    if min_price is not None:
+        queryset = queryset.filter(price_value__gte = float(min_price))
+    if max_price is not None:
+        queryset = queryset.filter(price_value__lte = float(max_price))
+    if min_discount is not None:
+        queryset = queryset.filter(percentage_discount__gte = min_discount)
+    if max_discount is not None:
+        queryset = queryset.filter(percentage_discount__lte = max_discount)
+    return queryset
+
+
+def serialize_row(row: dict) -> dict:
+    # same JSON shape as product_pydantic (decimals as strings, ISO dates)
+    for key, value in row.items():
+        if isinstance(value, Decimal):
+            row[key] = str(value)
+        elif isinstance(value, (date, datetime)):
+            row[key] = value.isoformat()
+    return row
+
+
+async def fetch_page(queryset: QuerySet, fields: List[str], cursor: Optional[int], limit: int):
+    # keyset pagination on the primary key, cursor is the last id already seen
+    if cursor is not None:
+        queryset = queryset.filter(id__gt = cursor)
+
+    # one extra row tells us whether another page exists
+    rows = await queryset.order_by("id").limit(limit + 1).values(*fields)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["id"]
+
+    return [serialize_row(row) for row in rows], next_cursor
+
+
+async def iter_product_chunks(
+    queryset: QuerySet,
+    fields: List[str],
+    cursor: Optional[int] = None,
+    limit: Optional[int] = None
+) -> AsyncIterator[List[dict]]:
+    # serialized rows read from the DB in keyset chunks, memory stays flat for any catalog size
+    sent = 0
+    while limit is None or sent < limit:
+        chunk_size = STREAM_CHUNK_SIZE if limit is None else min(STREAM_CHUNK_SIZE, limit - sent)
+        chunk = queryset if cursor is None else queryset.filter(id__gt = cursor)
+        rows = await chunk.order_by("id").limit(chunk_size).values(*fields)
+        if not rows:
+            break
+
+        cursor = rows[-1]["id"]
+        sent += len(rows)
+        yield [serialize_row(row) for row in rows]
+
+        if len(rows) < chunk_size:
+            break
+
+    logger.debug("Streamed %s products", sent)
+
+
+async def stream_products(
+    queryset: QuerySet,
+    fields: List[str],
+    cursor: Optional[int] = None,
+    limit: Optional[int] = None
+) -> AsyncIterator[bytes]:
+    # NDJSON, one product per line
+    async for rows in iter_product_chunks(queryset, fields, cursor, limit):
+        yield b"".join(orjson.dumps(row) + b"\n" for row in rows)
+
+
+# business and owner columns read through the product's foreign keys in the same query
+BUSINESS_DETAIL_FIELDS = {
+    "_business_name": "business_owner__business_name",
+    "_business_city": "business_owner__city",
+    "_business_region": "business_owner__region",
+    "_business_description": "business_owner__business_description",
+    "_business_logo": "business_owner__logo",
+    "_business_id": "business_owner__id",
+    "_owner_id": "business_owner__owner__id",
+    "_owner_email": "business_owner__owner__email",
+    "_owner_join_date": "business_owner__owner__join_date",
+}
+
+
+def build_product_details(row: dict) -> dict:
+    return {
+        "product_details": serialize_row({field: row[field] for field in PRODUCT_FIELDS}),
+        "business_details": {
+            "name": row["_business_name"],
+            "city": row["_business_city"],
+            "region": row["_business_region"],
+            "description": row["_business_description"],
+            "logo": row["_business_logo"],
+            "owner_id": row["_owner_id"],
+            "business_id": row["_business_id"],
+            "email": row["_owner_email"],
+            "join_date": row["_owner_join_date"].strftime("%b %d %Y")
+        }
+    }
+
+
+async def fetch_product_details(ids: List[int]) -> List[dict]:
+    # one joined query for any number of products, returned in the order requested
+    rows = await Product.filter(id__in = ids).values(*PRODUCT_FIELDS, **BUSINESS_DETAIL_FIELDS)
+    by_id = {row["id"]: row for row in rows}
+    return [build_product_details(by_id[id]) for id in ids if id in by_id]
+
+
+def parse_ids(ids: str) -> List[int]:
+    try:
+        parsed = list(dict.fromkeys(int(id) for id in ids.split(",") if id.strip()))
+    except ValueError:
+        raise HTTPException(
+            status_code = status.HTTP_400_BAD_REQUEST,
+            detail = "ids must be a comma separated list of integers"
+        )
+
+    if len(parsed) > MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code = status.HTTP_400_BAD_REQUEST,
+            detail = f"At most {MAX_PAGE_SIZE} ids can be requested at once"
+        )
+    return parsed
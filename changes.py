@@ -0,0 +1,282 @@
+from fastapi import HTTPException, status
+from tortoise import connections
+from tortoise.transactions import in_transaction
+from dotenv import dotenv_values
+from typing import AsyncIterator
+from catalog import PRODUCT_FIELDS, serialize_row
+from models import Product, ProductChange, BusinessChange
+from cache import response_cache, invalidate_products, invalidate_business
+from encoding import dumps
+import asyncio
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+config_credentials = dotenv_values(".env")
+
+# changes older than this are pruned, consumers away for longer have to reload the catalog
+CHANGE_RETENTION_DAYS = int(config_credentials.get("CHANGE_RETENTION_DAYS") or 7)
+# how often each worker looks for new changes, to wake its event streams and drop its cached
+# responses for rows other workers wrote
+CHANGE_POLL_INTERVAL = float(config_credentials.get("CHANGE_POLL_INTERVAL") or 1)
+# comment line sent on idle streams so proxies do not close them
+CHANGE_KEEPALIVE = float(config_credentials.get("CHANGE_KEEPALIVE") or 15)
+PRUNE_INTERVAL = 3600
+# more product changes than this in one poll and the whole response cache is dropped instead
+INVALIDATION_BATCH = 10000
+
+# product_change gets one row per inserted, updated or deleted product, written
+# by triggers in the same transaction as the write, so bulk imports and the
+# expiry sweep are in the feed as well. Its AUTOINCREMENT id is the cursor.
+# SQLite has a single writer, so ids commit in order. On Postgres concurrent
+# transactions could commit their ids out of order and a consumer would skip
+# the lower one, the advisory lock makes product writes take their ids in
+# commit order. The trigger is deferred to commit time so the lock is only
+# held while committing, not for the whole transaction: product writes still
+# commit one at a time, but their transactions otherwise run concurrently.
+# business_change records business updates and deletes the same way, for the
+# product details that embed the seller's business.
+SQLITE_SCHEMA = [
+    """CREATE TRIGGER IF NOT EXISTS product_change_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_change (product_id, operation) VALUES (NEW.id, 'insert');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_change_update AFTER UPDATE ON product BEGIN
+        INSERT INTO product_change (product_id, operation) VALUES (NEW.id, 'update');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_change_delete AFTER DELETE ON product BEGIN
+        INSERT INTO product_change (product_id, operation) VALUES (OLD.id, 'delete');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS business_change_update AFTER UPDATE ON business BEGIN
+        INSERT INTO business_change (business_id) VALUES (NEW.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS business_change_delete AFTER DELETE ON business BEGIN
+        INSERT INTO business_change (business_id) VALUES (OLD.id);
+    END""",
+]
+
+POSTGRES_SCHEMA = [
+    """CREATE OR REPLACE FUNCTION product_change_log() RETURNS TRIGGER AS $$
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtext('product_change'));
+        INSERT INTO product_change (product_id, operation)
+        VALUES (CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END, lower(TG_OP));
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS product_change_write ON product",
+    """CREATE CONSTRAINT TRIGGER product_change_write AFTER INSERT OR UPDATE OR DELETE ON product
+        DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE FUNCTION product_change_log()""",
+    """CREATE OR REPLACE FUNCTION business_change_log() RETURNS TRIGGER AS $$
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtext('business_change'));
+        INSERT INTO business_change (business_id) VALUES (OLD.id);
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS business_change_write ON business",
+    """CREATE CONSTRAINT TRIGGER business_change_write AFTER UPDATE OR DELETE ON business
+        DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE FUNCTION business_change_log()""",
+]
+
+# the newest entry is always kept, it carries the cursor forward after a quiet week
+SQLITE_PRUNE = """DELETE FROM {table} WHERE changed_at < datetime('now', ?)
+    AND id < (SELECT MAX(id) FROM {table})"""
+POSTGRES_PRUNE = """DELETE FROM {table} WHERE changed_at < now() - make_interval(days => $1)
+    AND id < (SELECT MAX(id) FROM {table})"""
+
+
+def _postgres() -> bool:
+    return connections.get("default").capabilities.dialect == "postgres"
+
+
+async def ensure_change_triggers():
+    # idempotent, part of "python database.py migrate"
+    async with in_transaction() as connection:
+        for statement in POSTGRES_SCHEMA if _postgres() else SQLITE_SCHEMA:
+            await connection.execute_query(statement)
+    logger.info("Product change feed triggers up to date")
+
+
+async def latest_change(model = ProductChange) -> int:
+    latest = await model.all().order_by("-id").limit(1).values_list("id", flat = True)
+    return latest[0] if latest else 0
+
+
+async def check_cursor(since: int):
+    # a cursor from before the oldest retained change has missed the pruned ones
+    oldest = await ProductChange.all().order_by("id").limit(1).values_list("id", flat = True)
+    if oldest and since < oldest[0] - 1:
+        raise HTTPException(
+            status_code = status.HTTP_410_GONE,
+            detail = "Changes since this cursor were pruned, reload GET /product and follow the feed from its latest cursor"
+        )
+
+
+async def fetch_changes(since: int, limit: int) -> dict:
+    """Changes after the ``since`` cursor, one entry per product with its current state.
+
+    A product written several times within the page is reported once, at its
+    last change. Inserts and updates carry the product as it is now, deletes
+    carry null. ``next_cursor`` is the cursor for the following call.
+    """
+    rows = await ProductChange.filter(id__gt = since).order_by("id").limit(limit + 1) \
+        .values("id", "product_id", "operation", "changed_at")
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    last = {row["product_id"]: row for row in rows}
+    products = await Product.filter(id__in = list(last)).values(*PRODUCT_FIELDS) if last else []
+    current = {product["id"]: serialize_row(product) for product in products}
+    data = [
+        {
+            "seq": row["id"],
+            "id": row["product_id"],
+            "change": row["operation"],
+            "changed_at": row["changed_at"],
+            "product": current.get(row["product_id"])
+        }
+        for row in sorted(last.values(), key = lambda row: row["id"])
+    ]
+    return {"status": "ok", "data": data, "next_cursor": rows[-1]["id"] if rows else since, "has_more": has_more}
+
+
+class ChangeFeed:
+    """Follows product and business writes from every worker.
+
+    Drops this worker's cached responses for the rows that changed, wakes its
+    open event streams and prunes old changes.
+    """
+
+    def __init__(self, poll_interval: float, keepalive: float, retention_days: int):
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+        self.retention_days = retention_days
+        self.latest = 0
+        self.business_latest = 0
+        self.invalidations = 0
+        self.subscribers = 0
+        self.events = 0
+        self.pruned = 0
+        self._changed = asyncio.Condition()
+        self._stopped = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        self._stopped.clear()
+        try:
+            self.latest = await latest_change()
+            self.business_latest = await latest_change(BusinessChange)
+        except Exception as e:
+            # not migrated yet, streams start from 0 and the poll loop catches up once the table exists
+            logger.warning("Product change feed unavailable, run python database.py migrate: %s", e)
+        self._task = asyncio.create_task(self._run())
+        logger.info("Product change feed started at %s", self.latest)
+
+    async def stop(self):
+        # ends any stream still open, clients reconnect with Last-Event-ID
+        self._stopped.set()
+        async with self._changed:
+            self._changed.notify_all()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def prune(self) -> int:
+        connection = connections.get("default")
+        count = 0
+        for table in ("product_change", "business_change"):
+            if _postgres():
+                pruned, _ = await connection.execute_query(POSTGRES_PRUNE.format(table = table), [self.retention_days])
+            else:
+                pruned, _ = await connection.execute_query(SQLITE_PRUNE.format(table = table), [f"-{self.retention_days} days"])
+            count += pruned
+        self.pruned += count
+        if count:
+            logger.info("Pruned %s product changes", count)
+        return count
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_prune = loop.time()
+        while not self._stopped.is_set():
+            try:
+                if loop.time() >= next_prune:
+                    next_prune = loop.time() + PRUNE_INTERVAL
+                    await self.prune()
+                latest = await latest_change()
+                if latest > self.latest:
+                    await self.invalidate_products(latest)
+                    self.latest = latest
+                    async with self._changed:
+                        self._changed.notify_all()
+                business_latest = await latest_change(BusinessChange)
+                if business_latest > self.business_latest:
+                    await self.invalidate_businesses(business_latest)
+                    self.business_latest = business_latest
+            except Exception as e:
+                logger.error("Product change feed poll failed: %s", e)
+            try:
+                await asyncio.wait_for(self._stopped.wait(), timeout = self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def invalidate_products(self, latest: int):
+        # the worker that wrote them already did, this covers every other one
+        if response_cache.shared:
+            return
+        if latest - self.latest > INVALIDATION_BATCH:
+            await response_cache.clear()
+        else:
+            ids = await ProductChange.filter(id__gt = self.latest, id__lte = latest).values_list("product_id", flat = True)
+            await invalidate_products(set(ids))
+        self.invalidations += 1
+
+    async def invalidate_businesses(self, latest: int):
+        if response_cache.shared:
+            return
+        ids = await BusinessChange.filter(id__gt = self.business_latest, id__lte = latest).values_list("business_id", flat = True)
+        for id in set(ids):
+            await invalidate_business(id)
+        self.invalidations += 1
+
+    async def stream(self, since: int) -> AsyncIterator[bytes]:
+        """Server-Sent Events, one "change" event per product with the cursor as its id.
+
+        Call check_cursor first, an error cannot be reported once the stream started.
+        """
+        self.subscribers += 1
+        try:
+            while not self._stopped.is_set():
+                page = await fetch_changes(since, 500)
+                for change in page["data"]:
+                    self.events += 1
+                    yield b"id: %d\nevent: change\ndata: %s\n\n" % (change["seq"], dumps(change))
+                since = page["next_cursor"]
+                if page["has_more"]:
+                    continue
+
+                idle = False
+                async with self._changed:
+                    if self.latest <= since and not self._stopped.is_set():
+                        try:
+                            await asyncio.wait_for(self._changed.wait(), timeout = self.keepalive)
+                        except asyncio.TimeoutError:
+                            idle = True
+                if idle:
+                    yield b": keepalive\n\n"
+        finally:
+            self.subscribers -= 1
+
+    def stats(self):
+        return {
+            "latest": self.latest,
+            "business_latest": self.business_latest,
+            "invalidations": self.invalidations,
+            "subscribers": self.subscribers,
+            "events": self.events,
+            "pruned": self.pruned,
+            "retention_days": self.retention_days
+        }
+
+
+change_feed = ChangeFeed(CHANGE_POLL_INTERVAL, CHANGE_KEEPALIVE, CHANGE_RETENTION_DAYS)
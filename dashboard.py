@@ -0,0 +1,105 @@
+from tortoise import connections
+from tortoise.transactions import in_transaction
+from dotenv import dotenv_values
+from datetime import date, datetime, timedelta
+from models import BusinessOfferStats
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+config_credentials = dotenv_values(".env")
+
+# offers ending within this many days count as expiring soon
+EXPIRING_SOON_DAYS = int(config_credentials.get("EXPIRING_SOON_DAYS") or 7)
+
+# business_offer_stats holds one row per business and expiry day with the
+# number of products and the sum of their discounts. Triggers move a product
+# between rows on every insert, update and delete, bulk inserts included, so
+# a dashboard reads a handful of rows instead of scanning the seller's products.
+SQLITE_SCHEMA = [
+    """CREATE TRIGGER IF NOT EXISTS business_offer_stats_insert AFTER INSERT ON product BEGIN
+        INSERT INTO business_offer_stats (business_id, expires_on, products, discount_total)
+        VALUES (NEW.business_owner_id, NEW.offer_expiration_date, 1, CAST(NEW.percentage_discount AS INTEGER))
+        ON CONFLICT (business_id, expires_on) DO UPDATE SET
+            products = products + 1, discount_total = discount_total + excluded.discount_total;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS business_offer_stats_update
+    AFTER UPDATE OF business_owner_id, offer_expiration_date, percentage_discount ON product BEGIN
+        UPDATE business_offer_stats SET
+            products = products - 1, discount_total = discount_total - CAST(OLD.percentage_discount AS INTEGER)
+        WHERE business_id = OLD.business_owner_id AND expires_on = OLD.offer_expiration_date;
+        INSERT INTO business_offer_stats (business_id, expires_on, products, discount_total)
+        VALUES (NEW.business_owner_id, NEW.offer_expiration_date, 1, CAST(NEW.percentage_discount AS INTEGER))
+        ON CONFLICT (business_id, expires_on) DO UPDATE SET
+            products = products + 1, discount_total = discount_total + excluded.discount_total;
+        DELETE FROM business_offer_stats WHERE business_id = OLD.business_owner_id AND products = 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS business_offer_stats_delete AFTER DELETE ON product BEGIN
+        UPDATE business_offer_stats SET
+            products = products - 1, discount_total = discount_total - CAST(OLD.percentage_discount AS INTEGER)
+        WHERE business_id = OLD.business_owner_id AND expires_on = OLD.offer_expiration_date;
+        DELETE FROM business_offer_stats WHERE business_id = OLD.business_owner_id AND products = 0;
+    END""",
+]
+
+POSTGRES_SCHEMA = [
+    """CREATE OR REPLACE FUNCTION business_offer_stats_refresh() RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE business_offer_stats SET
+                products = products - 1, discount_total = discount_total - OLD.percentage_discount
+            WHERE business_id = OLD.business_owner_id AND expires_on = OLD.offer_expiration_date;
+            DELETE FROM business_offer_stats WHERE business_id = OLD.business_owner_id AND products = 0;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO business_offer_stats (business_id, expires_on, products, discount_total)
+            VALUES (NEW.business_owner_id, NEW.offer_expiration_date, 1, NEW.percentage_discount)
+            ON CONFLICT (business_id, expires_on) DO UPDATE SET
+                products = business_offer_stats.products + 1,
+                discount_total = business_offer_stats.discount_total + EXCLUDED.discount_total;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS business_offer_stats_write ON product",
+    """CREATE TRIGGER business_offer_stats_write
+        AFTER INSERT OR DELETE OR UPDATE OF business_owner_id, offer_expiration_date, percentage_discount ON product
+        FOR EACH ROW EXECUTE FUNCTION business_offer_stats_refresh()""",
+]
+
+# rebuilt from product on every migrate, in the same transaction as the triggers
+REBUILD = [
+    "DELETE FROM business_offer_stats",
+    """INSERT INTO business_offer_stats (business_id, expires_on, products, discount_total)
+    SELECT business_owner_id, offer_expiration_date, COUNT(*), SUM(CAST(percentage_discount AS INTEGER))
+    FROM product GROUP BY business_owner_id, offer_expiration_date""",
+]
+
+
+async def ensure_stats_triggers():
+    # idempotent, part of "python database.py migrate"
+    postgres = connections.get("default").capabilities.dialect == "postgres"
+    async with in_transaction() as connection:
+        for statement in (POSTGRES_SCHEMA if postgres else SQLITE_SCHEMA) + REBUILD:
+            await connection.execute_query(statement)
+    logger.info("Business offer stats up to date")
+
+
+async def business_stats(business_id: int, today: date = None) -> dict:
+    """Active products, their average discount and how many expire soon, read from the aggregate rows."""
+    # same clock as the offer_expiration_date default
+    today = today or datetime.utcnow().date()
+    soon = today + timedelta(days = EXPIRING_SOON_DAYS)
+    # one row per future expiry day, independent of the number of products
+    rows = await BusinessOfferStats.filter(business_id = business_id, expires_on__gte = today) \
+        .values_list("expires_on", "products", "discount_total")
+
+    active = sum(products for _, products, _ in rows)
+    discount_total = sum(total for _, _, total in rows)
+    return {
+        "active_products": active,
+        "average_discount": round(discount_total / active, 2) if active else 0,
+        "expiring_soon": sum(products for expires_on, products, _ in rows if expires_on < soon),
+        "expiring_within_days": EXPIRING_SOON_DAYS
+    }
@@ -0,0 +1,68 @@
+"""orjson based JSON encoding for every endpoint.
+
+FastAPI runs an endpoint's return value through jsonable_encoder, which walks
+it and rebuilds every pydantic model as a dict, and then encodes the result
+with the stdlib json module. Routes created with OrjsonRoute instead hand the
+returned value straight to orjson: pydantic models are serialized to bytes by
+pydantic-core and embedded as they are, decimals become strings exactly as
+pydantic writes them and dates use ISO 8601.
+"""
+from fastapi.responses import ORJSONResponse
+from fastapi.routing import APIRoute
+from starlette.responses import Response
+from pydantic import BaseModel
+from decimal import Decimal
+import asyncio
+import functools
+import orjson
+
+
+def _default(value):
+    if isinstance(value, BaseModel):
+        return orjson.Fragment(value.__pydantic_serializer__.to_json(value, by_alias = True))
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    return orjson.dumps(content, default = _default, option = orjson.OPT_NON_STR_KEYS)
+
+
+class OrjsonResponse(ORJSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+class OrjsonRoute(APIRoute):
+    """Wraps the endpoint's plain return values in OrjsonResponse, skipping jsonable_encoder.
+
+    Routes declaring a response_model keep FastAPI's validation and encoding.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.response_model is not None or self.dependant.call is None:
+            return
+
+        call = self.dependant.call
+        status_code = self.status_code
+
+        def respond(content):
+            if isinstance(content, Response):
+                return content
+            return OrjsonResponse(content, status_code = status_code or 200)
+
+        if asyncio.iscoroutinefunction(call):
+            @functools.wraps(call)
+            async def endpoint(**values):
+                return respond(await call(**values))
+        else:
+            @functools.wraps(call)
+            def endpoint(**values):
+                return respond(call(**values))
+
+        # the dependencies were resolved from the original signature, only the call changes
+        self.dependant.call = endpoint
@@ -0,0 +1,135 @@
+from tortoise import connections
+from dotenv import dotenv_values
+from datetime import date, datetime, time, timedelta
+from typing import Optional
+from models import Product
+from cache import invalidate_products
+import asyncio
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+config_credentials = dotenv_values(".env")
+
+# products deactivated per UPDATE, keeps each write transaction short
+EXPIRY_BATCH_SIZE = int(config_credentials.get("EXPIRY_BATCH_SIZE") or 1000)
+# longest sleep between sweeps, even when the next expiry is further away
+EXPIRY_INTERVAL = float(config_credentials.get("EXPIRY_INTERVAL") or 3600)
+
+# Product.active is false once the offer_expiration_date has passed. Writes set
+# it from the date they store, the scheduler flips it for offers that run out
+# while nobody touches them. (active, id) serves the catalog's keyset pages,
+# (active, offer_expiration_date) the scheduler's next-expiry lookup.
+SQLITE_COLUMN = "ALTER TABLE product ADD COLUMN active INT NOT NULL DEFAULT 1"
+POSTGRES_COLUMN = "ALTER TABLE product ADD COLUMN IF NOT EXISTS active BOOL NOT NULL DEFAULT TRUE"
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS product_active_id ON product (active, id)",
+    "CREATE INDEX IF NOT EXISTS product_active_expiry ON product (active, offer_expiration_date)",
+]
+
+
+def today() -> date:
+    # same clock as the offer_expiration_date default
+    return datetime.utcnow().date()
+
+
+def offer_active(expiration: Optional[date]) -> bool:
+    # an offer runs through its expiration date, the model default is today
+    return expiration is None or expiration >= today()
+
+
+async def ensure_expiry_schema():
+    # idempotent, part of "python database.py migrate", adds the column to databases created before it
+    connection = connections.get("default")
+    if connection.capabilities.dialect == "postgres":
+        await connection.execute_script(POSTGRES_COLUMN)
+    else:
+        columns = await connection.execute_query_dict("PRAGMA table_info(product)")
+        if not any(column["name"] == "active" for column in columns):
+            await connection.execute_script(SQLITE_COLUMN)
+    for statement in INDEXES:
+        await connection.execute_script(statement)
+    logger.info("Product expiry index up to date")
+
+
+class ExpiryScheduler:
+    """Deactivates expired offers in batches and drops the cached pages that listed them."""
+
+    def __init__(self, batch_size: int, interval: float):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.runs = 0
+        self.expired = 0
+        self.last_run = None
+        self.next_run = None
+        self._task = None
+        self._stopped = asyncio.Event()
+
+    async def start(self):
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Offer expiry scheduler started")
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def expire_due(self) -> int:
+        """Deactivate every active product whose offer ended before today."""
+        cutoff = today()
+        total = 0
+        while True:
+            ids = await Product.filter(active = True, offer_expiration_date__lt = cutoff) \
+                .order_by("offer_expiration_date").limit(self.batch_size).values_list("id", flat = True)
+            if not ids:
+                break
+            # the date check again, a concurrent update may have extended one of them meanwhile
+            await Product.filter(id__in = ids, active = True, offer_expiration_date__lt = cutoff).update(active = False)
+            await invalidate_products(ids)
+            total += len(ids)
+
+        self.runs += 1
+        self.expired += total
+        self.last_run = datetime.utcnow()
+        if total:
+            logger.info("Deactivated %s expired offers", total)
+        return total
+
+    async def _seconds_until_next(self) -> float:
+        # the earliest active expiry date comes straight off the index, it lapses at the following midnight
+        earliest = await Product.filter(active = True).order_by("offer_expiration_date") \
+            .limit(1).values_list("offer_expiration_date", flat = True)
+        if not earliest:
+            return self.interval
+        lapses = datetime.combine(max(earliest[0], today()) + timedelta(days = 1), time.min)
+        return min(max((lapses - datetime.utcnow()).total_seconds(), 1), self.interval)
+
+    async def _run(self):
+        while not self._stopped.is_set():
+            try:
+                await self.expire_due()
+                delay = await self._seconds_until_next()
+            except Exception as e:
+                logger.error("Offer expiry sweep failed: %s", e)
+                delay = self.interval
+            self.next_run = datetime.utcnow() + timedelta(seconds = delay)
+            try:
+                await asyncio.wait_for(self._stopped.wait(), timeout = delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {
+            "batch_size": self.batch_size,
+            "runs": self.runs,
+            "expired": self.expired,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "next_run": self.next_run.isoformat() if self.next_run else None
+        }
+
+
+expiry_scheduler = ExpiryScheduler(EXPIRY_BATCH_SIZE, EXPIRY_INTERVAL)
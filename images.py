@@ -0,0 +1,345 @@
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, UploadFile, status
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, JSONResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from dotenv import dotenv_values
+from typing import Dict, Optional
+from metrics import span
+import asyncio
+import hashlib
+import mimetypes
+import secrets
+import os
+import re
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+config_credentials = dotenv_values(".env")
+
+IMAGE_DIR = "./static/images/"
+IMAGE_WORKERS = int(config_credentials.get("IMAGE_WORKERS") or max(1, (os.cpu_count() or 1) - 1))
+MAX_UPLOAD_SIZE = int(config_credentials.get("MAX_UPLOAD_SIZE") or 10 * 1024 * 1024)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# room for the multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD = 16 * 1024
+# body bytes searched for the first file part's headers, beyond that the handler decides
+SNIFF_LIMIT = 64 * 1024
+
+# variant name -> bounding box, the thumbnail is cropped to exactly this size
+IMAGE_SIZES = {
+    "thumbnail": (200, 200),
+    "listing": (600, 600),
+    "full": (1600, 1600),
+}
+PIL_FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
+# leading bytes of every accepted upload format
+MAGIC_BYTES = {
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"\xff\xd8\xff": "jpg",
+}
+MAGIC_LENGTH = max(map(len, MAGIC_BYTES))
+
+# where clients fetch images from, e.g. https://cdn.example.com/images/ in front of /static/images/
+PUBLIC_IMAGE_URL = config_credentials.get("PUBLIC_IMAGE_URL") or "localhost:8000/static/images/"
+# "x-accel" (nginx) or "x-sendfile" (Apache, lighttpd) hands the file transfer to the front server
+IMAGE_OFFLOAD = config_credentials.get("IMAGE_OFFLOAD") or ""
+# nginx internal location that maps onto IMAGE_DIR, used with x-accel
+IMAGE_OFFLOAD_PREFIX = config_credentials.get("IMAGE_OFFLOAD_PREFIX") or "/internal/images/"
+# content-hashed names never change content, anything else (the defaults) may be replaced
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MUTABLE_CACHE_CONTROL = "public, max-age=3600"
+HASHED_NAME = re.compile(r"^([0-9a-f]{32})(_[a-z]+)?\.(jpg|png|webp)$")
+
+
+def detect_format(head: bytes) -> Optional[str]:
+    for magic, extension in MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return extension
+    return None
+
+
+def first_file_content(body: bytes, boundary: bytes) -> Optional[bytes]:
+    """What has arrived of the first file part's content, None until its headers are complete."""
+    delimiter = b"--" + boundary
+    position = 0
+    while True:
+        start = body.find(delimiter, position)
+        if start < 0:
+            return None
+        headers_end = body.find(b"\r\n\r\n", start)
+        if headers_end < 0:
+            return None
+        if b"filename=" in body[start:headers_end].lower():
+            return body[headers_end + 4:]
+        position = headers_end + 4
+
+
+def unsupported_format():
+    return HTTPException(
+        status_code = status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        detail = "Only PNG and JPEG images are allowed"
+    )
+
+
+def content_name(digest: str, extension: str) -> str:
+    # identical uploads map to the same file, so they are stored and processed once
+    return f"{digest[:32]}.{extension}"
+
+
+def variant_names(name: str) -> Dict[str, str]:
+    base, extension = os.path.splitext(name)
+    names = {}
+    for size in IMAGE_SIZES:
+        names[size] = f"{base}_{size}{extension}"
+        names[f"{size}_webp"] = f"{base}_{size}.webp"
+    return names
+
+
+def image_url(name: str) -> str:
+    return PUBLIC_IMAGE_URL.rstrip("/") + "/" + name
+
+
+def _save(img: "Image.Image", path: str, extension: str):
+    if extension == "jpg" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    temp_path = path + ".part"
+    img.save(temp_path, format = PIL_FORMATS[extension], optimize = True, quality = 85)
+    os.replace(temp_path, path)
+
+
+def process_image(path: str) -> Dict[str, str]:
+    """Decode the upload once and write every size in its own format and as WebP.
+
+    Runs in the image worker processes, which are the only ones that import Pillow.
+    """
+    from PIL import Image, ImageOps
+
+    directory, name = os.path.split(path)
+    extension = name.rsplit(".", 1)[1]
+    names = variant_names(name)
+
+    with Image.open(path) as source:
+        source = ImageOps.exif_transpose(source)
+        source.load()
+
+    for size, box in IMAGE_SIZES.items():
+        if size == "thumbnail":
+            img = ImageOps.fit(source, box, Image.LANCZOS)
+        else:
+            img = source.copy()
+            img.thumbnail(box, Image.LANCZOS)
+        _save(img, os.path.join(directory, names[size]), extension)
+        _save(img, os.path.join(directory, names[f"{size}_webp"]), "webp")
+
+    return names
+
+
+class ImagePipeline:
+    """Schedules process_image on a process pool without blocking the request."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.completed = 0
+        self.failed = 0
+        self._executor = None
+        self._tasks = {}
+
+    def submit(self, path: str):
+        # one job per content hash, a duplicate upload reuses the running job
+        if path in self._tasks:
+            return self._tasks[path]
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers = self.workers)
+
+        future = asyncio.get_running_loop().run_in_executor(self._executor, process_image, path)
+        task = asyncio.ensure_future(self._track(path, future))
+        self._tasks[path] = task
+        return task
+
+    async def _track(self, path: str, future):
+        try:
+            with span("image_resize"):
+                names = await future
+            self.completed += 1
+            logger.info("Image variants generated for %s", path)
+            return names
+        except Exception as e:
+            self.failed += 1
+            logger.error("Image processing failed for %s: %s", path, e)
+        finally:
+            self._tasks.pop(path, None)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "in_flight": len(self._tasks),
+            "completed": self.completed,
+            "failed": self.failed
+        }
+
+    async def shutdown(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions = True)
+        if self._executor is not None:
+            self._executor.shutdown(wait = True)
+            self._executor = None
+
+
+image_pipeline = ImagePipeline(IMAGE_WORKERS)
+
+
+def too_large():
+    return HTTPException(
+        status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail = f"Upload exceeds the {MAX_UPLOAD_SIZE} byte limit"
+    )
+
+
+async def store_upload(file: UploadFile) -> str:
+    """Stream the upload to disk under its content hash and queue variant generation.
+
+    The format comes from the magic bytes of the first chunk (UploadLimitMiddleware
+    has already turned away most other files) and the hash and size are computed
+    while streaming. Returns the stored file name as soon as the original is on disk.
+    """
+    temp_path = os.path.join(IMAGE_DIR, secrets.token_hex(10) + ".part")
+    digest = hashlib.sha256()
+    size = 0
+    extension = None
+
+    out = await asyncio.to_thread(open, temp_path, "wb")
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            if extension is None:
+                extension = detect_format(chunk)
+                if extension is None:
+                    raise unsupported_format()
+
+            size += len(chunk)
+            if size > MAX_UPLOAD_SIZE:
+                raise too_large()
+
+            digest.update(chunk)
+            await asyncio.to_thread(out.write, chunk)
+
+        if extension is None:
+            raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail = "Empty upload")
+
+        # durable before it becomes visible under its final name
+        await asyncio.to_thread(out.flush)
+        await asyncio.to_thread(os.fsync, out.fileno())
+    except BaseException:
+        out.close()
+        os.remove(temp_path)
+        raise
+    out.close()
+
+    name = content_name(digest.hexdigest(), extension)
+    path = os.path.join(IMAGE_DIR, name)
+
+    if os.path.exists(path):
+        os.remove(temp_path)
+        logger.info("Image %s already stored, skipping upload", name)
+        # full_webp is written last, redo the variants if an earlier run died half way
+        if not os.path.exists(os.path.join(IMAGE_DIR, variant_names(name)["full_webp"])):
+            image_pipeline.submit(path)
+        return name
+
+    os.replace(temp_path, path)
+    image_pipeline.submit(path)
+    return name
+
+
+class UploadLimitMiddleware:
+    """Rejects oversized uploads and files that are not images before the body is fully received.
+
+    Declared sizes are checked against Content-Length up front, bodies without
+    one are counted as they arrive and cut off at the limit. The request is
+    parsed into a temporary file before the handler runs, so the format is
+    checked here as well: the magic bytes of the first file in the multipart
+    body are looked at as soon as they arrive.
+    """
+
+    def __init__(self, app, max_size: int = MAX_UPLOAD_SIZE, path_prefix: str = "/uploadfile"):
+        self.app = app
+        self.max_body = max_size + MULTIPART_OVERHEAD
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefix):
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and int(content_length) > self.max_body:
+            response = JSONResponse({"detail": too_large().detail}, status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            return await response(scope, receive, send)
+
+        _, _, boundary = headers.get(b"content-type", b"").partition(b"boundary=")
+        boundary = boundary.split(b";")[0].strip().strip(b'"')
+        received = 0
+        # None once the format is decided, or left to the handler
+        head = b"" if boundary else None
+
+        async def limited_receive():
+            nonlocal received, head
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                received += len(body)
+                if received > self.max_body:
+                    raise too_large()
+                if head is not None:
+                    head += body
+                    content = first_file_content(head, boundary)
+                    if content is not None and (len(content) >= MAGIC_LENGTH or not message.get("more_body")):
+                        head = None
+                        # an empty file is the handler's to report
+                        if detect_format(content) is None and not content.startswith(b"\r\n--" + boundary):
+                            raise unsupported_format()
+                    elif len(head) > SNIFF_LIMIT:
+                        head = None
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class ImageFiles(StaticFiles):
+    """Serves IMAGE_DIR with cache headers suited to a CDN, or hands the transfer to the front server.
+
+    Content-hashed names are immutable and get a year long Cache-Control and
+    an ETag derived from the name. Conditional and Range requests are answered
+    by FileResponse.
+    """
+
+    async def get_response(self, path: str, scope) -> Response:
+        # uploads still being written
+        if path.endswith(".part"):
+            raise HTTPException(status_code = status.HTTP_404_NOT_FOUND)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        name = os.path.basename(full_path)
+        hashed = HASHED_NAME.match(name)
+        headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL if hashed else MUTABLE_CACHE_CONTROL}
+        if hashed:
+            headers["ETag"] = '"' + name.rsplit(".", 1)[0] + '"'
+
+        media_type = mimetypes.guess_type(name)[0]
+        if IMAGE_OFFLOAD == "x-accel":
+            headers["X-Accel-Redirect"] = IMAGE_OFFLOAD_PREFIX + name
+            response = Response(status_code = status_code, headers = headers, media_type = media_type)
+        elif IMAGE_OFFLOAD == "x-sendfile":
+            headers["X-Sendfile"] = os.path.abspath(full_path)
+            response = Response(status_code = status_code, headers = headers, media_type = media_type)
+        else:
+            response = FileResponse(full_path, status_code = status_code, stat_result = stat_result, headers = headers)
+
+        if self.is_not_modified(response.headers, Headers(scope = scope)):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,207 @@
+"""Logging setup: records are queued on the caller's thread and written by a background listener.
+
+Handlers called from a request only build the LogRecord and put it on a
+bounded queue, the file write, JSON encoding and rotation all happen on the
+listener thread. Every record carries the id of the request it was logged
+from, taken from the X-Request-ID header or generated per request.
+"""
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from contextvars import ContextVar
+from dotenv import dotenv_values
+from datetime import datetime, timezone
+import atexit
+import copy
+import json
+import logging
+import queue
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+config_credentials = dotenv_values(".env")
+
+LOG_FILE = config_credentials.get("LOG_FILE") or "app.log"
+LOG_LEVEL = (config_credentials.get("LOG_LEVEL") or "INFO").upper()
+# "json" for one object per line, "text" for the old human readable lines
+LOG_FORMAT = config_credentials.get("LOG_FORMAT") or "json"
+# rotate at LOG_MAX_BYTES, or on a schedule when LOG_ROTATE_WHEN is set (e.g. "midnight", "H")
+LOG_MAX_BYTES = int(config_credentials.get("LOG_MAX_BYTES") or 10 * 1024 * 1024)
+LOG_ROTATE_WHEN = config_credentials.get("LOG_ROTATE_WHEN") or ""
+LOG_BACKUPS = int(config_credentials.get("LOG_BACKUPS") or 5)
+# records waiting for the writer, beyond this they are dropped instead of blocking requests
+LOG_QUEUE_SIZE = int(config_credentials.get("LOG_QUEUE_SIZE") or 10000)
+
+request_id = ContextVar("request_id", default = None)
+
+# attributes every LogRecord has, anything else was passed through extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "request_id"}
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamps the current request id on the record while still on the logging thread."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec = "milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default = str)
+
+
+class AsyncQueueHandler(QueueHandler):
+    """Non-blocking queue handler that defers formatting to the listener thread."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.addFilter(RequestIdFilter())
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # only resolve what may change after this call returns: the message
+        # arguments and the traceback, the output format is applied by the writer
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def build_file_handler() -> logging.Handler:
+    if LOG_ROTATE_WHEN:
+        handler = TimedRotatingFileHandler(LOG_FILE, when = LOG_ROTATE_WHEN, backupCount = LOG_BACKUPS, encoding = "utf-8")
+    else:
+        handler = RotatingFileHandler(LOG_FILE, maxBytes = LOG_MAX_BYTES, backupCount = LOG_BACKUPS, encoding = "utf-8")
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(request_id)s - %(message)s"))
+    return handler
+
+
+_listener = None
+_handler = None
+
+
+def setup_logging(log_queue = None):
+    """Route the root logger through a queue, once per process.
+
+    Without a queue the records are written by a listener thread of this
+    process. serve.py passes a multiprocessing queue instead, so every worker
+    feeds the single writer in the supervisor (see start_writer).
+    """
+    global _handler
+    if _handler is not None:
+        return
+
+    if log_queue is None:
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        start_writer(log_queue)
+    _handler = AsyncQueueHandler(log_queue)
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(_handler)
+    atexit.register(stop_logging)
+
+
+def start_writer(log_queue):
+    global _listener
+    _listener = QueueListener(log_queue, build_file_handler(), respect_handler_level = True)
+    _listener.start()
+
+
+def forget_writer():
+    # in a forked worker, the listener thread only exists in the parent
+    global _listener
+    _listener = None
+
+
+def stop_logging():
+    """Write out everything still queued and stop the listener thread."""
+    global _listener, _handler
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _handler is not None:
+        if hasattr(_handler.queue, "join_thread"):
+            # multiprocessing queue, wait until its feeder thread has handed everything over
+            _handler.queue.close()
+            _handler.queue.join_thread()
+        _handler = None
+
+
+def stats() -> dict:
+    if _handler is None:
+        return {}
+    try:
+        queued = _handler.queue.qsize()
+    except NotImplementedError:
+        # multiprocessing queues cannot report their size on macOS
+        queued = None
+    return {"queued": queued, "max_queued": LOG_QUEUE_SIZE, "dropped": _handler.dropped}
+
+
+class RequestLogMiddleware:
+    """Assigns each request its correlation id and logs one line per request with its duration."""
+
+    def __init__(self, app, header: str = "x-request-id"):
+        self.app = app
+        self.header = header.encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        incoming = dict(scope["headers"]).get(self.header)
+        id = incoming.decode("latin-1")[:64] if incoming else uuid.uuid4().hex
+        token = request_id.set(id)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(self.header, id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "%s %s %s", scope["method"], scope["path"], status_code,
+                    extra = {
+                        "method": scope["method"],
+                        "path": scope["path"],
+                        "status": status_code,
+                        "duration_ms": round((time.perf_counter() - started) * 1000, 2)
+                    }
+                )
+            request_id.reset(token)
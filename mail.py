@@ -1,32 +1,226 @@
 from fastapi import BackgroundTasks, UploadFile, File, Form, Depends, HTTPException, status
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
 from dotenv import dotenv_values
 from pydantic import BaseModel, EmailStr
-from typing import List
-from models import User
+from typing import List, Optional
+from models import User, EmailJob
+from email.message import EmailMessage
+from datetime import datetime, timedelta
+import aiosmtplib
+import asyncio
 import jwt
 import logging
+from metrics import span
 
 logger = logging.getLogger(__name__)
 
 # Load environment variables
 config_credentials = dotenv_values(".env")
 
-# Email configuration
-conf = ConnectionConfig(
-    MAIL_USERNAME=config_credentials["EMAIL"],
-    MAIL_PASSWORD=config_credentials["PASSWORD"],
-    MAIL_FROM=config_credentials["EMAIL"],
-    MAIL_PORT=587,
-    MAIL_SERVER="smtp.gmail.com",
-    MAIL_STARTTLS=True,       # instead of MAIL_TLS
-    MAIL_SSL_TLS=False,       # instead of MAIL_SSL
-    USE_CREDENTIALS=True
-)
-
-# Send verification email
+# Email configuration, point MAIL_SERVER/MAIL_PORT at smtp_stub.py for local runs and tests.
+# Built on first use, fastapi_mail (and the email_validator and dnspython it loads) is a
+# noticeable share of the import time and only the mail workers need it
+_conf = None
+
+
+def mail_config():
+    global _conf
+    if _conf is None:
+        from fastapi_mail import ConnectionConfig
+
+        _conf = ConnectionConfig(
+            MAIL_USERNAME=config_credentials["EMAIL"],
+            MAIL_PASSWORD=config_credentials["PASSWORD"],
+            MAIL_FROM=config_credentials["EMAIL"],
+            MAIL_PORT=int(config_credentials.get("MAIL_PORT") or 587),
+            MAIL_SERVER=config_credentials.get("MAIL_SERVER") or "smtp.gmail.com",
+            MAIL_STARTTLS=config_credentials.get("MAIL_STARTTLS") or True,       # instead of MAIL_TLS
+            MAIL_SSL_TLS=False,       # instead of MAIL_SSL
+            USE_CREDENTIALS=config_credentials.get("USE_CREDENTIALS") or True
+        )
+    return _conf
+
+
+def __getattr__(name):
+    # mail.conf keeps working for callers that adjust the settings, e.g. the benchmarks
+    if name == "conf":
+        return mail_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Outbox tuning
+EMAIL_WORKERS = int(config_credentials.get("EMAIL_WORKERS") or 1)
+EMAIL_BATCH_SIZE = int(config_credentials.get("EMAIL_BATCH_SIZE") or 20)
+EMAIL_MAX_ATTEMPTS = int(config_credentials.get("EMAIL_MAX_ATTEMPTS") or 5)
+# retry delay is EMAIL_RETRY_BASE * 2 ** attempts seconds, capped at EMAIL_RETRY_MAX
+EMAIL_RETRY_BASE = float(config_credentials.get("EMAIL_RETRY_BASE") or 2)
+EMAIL_RETRY_MAX = float(config_credentials.get("EMAIL_RETRY_MAX") or 900)
+# idle workers re-check the table this often, new jobs wake them up immediately
+EMAIL_POLL_INTERVAL = float(config_credentials.get("EMAIL_POLL_INTERVAL") or 5)
+# a claimed job is retried by any worker if it is not finished within the lease
+EMAIL_LEASE_SECONDS = 120
+
+
+class EmailOutbox:
+    """Drains EmailJob rows over long lived SMTP connections, one per worker."""
+
+    def __init__(self, workers: int, batch_size: int, max_attempts: int):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def enqueue(self, recipients: List[str], subject: str, body: str, subtype: str = "html"):
+        job = await EmailJob.create(recipients = recipients, subject = subject, body = body, subtype = subtype)
+        self.notify()
+        return job
+
+    async def start(self):
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+        logger.info("Email outbox started with %s worker(s)", self.workers)
+
+    async def stop(self, drain: bool = True, timeout: float = 10):
+        # with drain, jobs that are already due are sent before the workers exit
+        self._stopping = True
+        self.notify()
+        if not drain:
+            for task in self._tasks:
+                task.cancel()
+        done, pending = await asyncio.wait(self._tasks, timeout = timeout) if self._tasks else (set(), set())
+        for task in pending:
+            task.cancel()
+        self._tasks = []
+        logger.info("Email outbox stopped")
+
+    async def pending(self) -> int:
+        return await EmailJob.filter(status = "pending").count()
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "batch_size": self.batch_size,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed
+        }
+
+    async def _claim_batch(self) -> List[EmailJob]:
+        now = datetime.utcnow()
+        due = await EmailJob.filter(status = "pending", next_attempt_at__lte = now) \
+            .order_by("next_attempt_at").limit(self.batch_size)
+
+        # optimistic lease, only the worker whose update still sees the version it read owns the job
+        claimed = []
+        lease = now + timedelta(seconds = EMAIL_LEASE_SECONDS)
+        for job in due:
+            updated = await EmailJob.filter(id = job.id, version = job.version) \
+                .update(version = job.version + 1, next_attempt_at = lease)
+            if updated:
+                job.version += 1
+                claimed.append(job)
+        return claimed
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        conf = mail_config()
+        smtp = aiosmtplib.SMTP(
+            hostname = conf.MAIL_SERVER,
+            port = conf.MAIL_PORT,
+            use_tls = conf.MAIL_SSL_TLS,
+            start_tls = conf.MAIL_STARTTLS,
+            timeout = conf.TIMEOUT
+        )
+        await smtp.connect()
+        if conf.USE_CREDENTIALS:
+            await smtp.login(conf.MAIL_USERNAME, conf.MAIL_PASSWORD.get_secret_value())
+        return smtp
+
+    async def _deliver(self, smtp: aiosmtplib.SMTP, job: EmailJob):
+        message = EmailMessage()
+        message["Subject"] = job.subject
+        message["From"] = mail_config().MAIL_FROM
+        message["To"] = ", ".join(job.recipients)
+        message.set_content(job.body, subtype = job.subtype)
+        await smtp.send_message(message)
+
+    async def _retry_later(self, job: EmailJob, error: Exception):
+        job.attempts += 1
+        job.last_error = str(error)
+        if job.attempts >= self.max_attempts:
+            job.status = "failed"
+            self.failed += 1
+            logger.error("Email job %s to %s failed after %s attempts: %s", job.id, job.recipients, job.attempts, error)
+        else:
+            delay = min(EMAIL_RETRY_BASE * 2 ** job.attempts, EMAIL_RETRY_MAX)
+            job.next_attempt_at = datetime.utcnow() + timedelta(seconds = delay)
+            self.retried += 1
+            logger.warning("Email job %s failed (%s), retrying in %.0fs", job.id, error, delay)
+        await job.save(update_fields = ["attempts", "last_error", "status", "next_attempt_at"])
+
+    async def _worker(self, number: int):
+        smtp = None
+        while True:
+            # cleared before claiming, a job queued while the claim runs sets it again and is not missed
+            self._wakeup.clear()
+            try:
+                jobs = await self._claim_batch()
+            except Exception as e:
+                logger.error("Email worker %s could not read the outbox: %s", number, e)
+                jobs = []
+
+            if not jobs:
+                if self._stopping:
+                    await self._close(smtp)
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout = EMAIL_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    # idle for a whole poll interval, close instead of letting the server drop it
+                    await self._close(smtp)
+                    smtp = None
+                continue
+
+            for job in jobs:
+                try:
+                    if smtp is None or not smtp.is_connected:
+                        with span("smtp_connect"):
+                            smtp = await self._connect()
+                    with span("email_send"):
+                        await self._deliver(smtp, job)
+                except Exception as e:
+                    await self._close(smtp)
+                    smtp = None
+                    await self._retry_later(job, e)
+                    continue
+
+                job.status = "sent"
+                job.attempts += 1
+                await job.save(update_fields = ["status", "attempts"])
+                self.sent += 1
+                logger.info("Verification email sent successfully to %s", job.recipients)
+
+    async def _close(self, smtp: Optional[aiosmtplib.SMTP]):
+        if smtp is None:
+            return
+        try:
+            await smtp.quit()
+        except Exception:
+            smtp.close()
+
+
+outbox = EmailOutbox(EMAIL_WORKERS, EMAIL_BATCH_SIZE, EMAIL_MAX_ATTEMPTS)
+
+
+# Queue verification email, delivered by the outbox workers
 async def send_email(email: List[str], instance: User):
-    logger.info(f"Generating token data for user: {instance.username}")
+    logger.info("Generating token data for user: %s", instance.username)
     token_data = {
         "id": instance.id,
         "username": instance.username
@@ -34,7 +228,7 @@ async def send_email(email: List[str], instance: User):
 
     # Generate JWT token
     token = jwt.encode(token_data, config_credentials["SECRET"], algorithm="HS256")
-    logger.debug(f"Token data generated for user: {instance.username}")
+    logger.debug("Token data generated for user: %s", instance.username)
     # Email HTML template
     template = f"""
         <!DOCTYPE html>
@@ -54,13 +248,6 @@ async def send_email(email: List[str], instance: User):
         </html>
     """
 
-    message = MessageSchema(
-        subject="Verification Email",
-        recipients=email,  # must be a list of strings
-        body=template,
-        subtype="html"
-    )
-    # LOG sending verification email
-    fm = FastMail(conf)
-    await fm.send_message(message=message)
-    logger.info(f"Verification email sent successfully to {email}")
+    # LOG queueing verification email
+    await outbox.enqueue(email, "Verification Email", template)
+    logger.info("Verification email queued for %s", email)
@@ -1,17 +1,15 @@
-from fastapi import FastAPI, HTTPException, Request, status, Depends
+from fastapi import FastAPI, HTTPException, Request, status, Depends, Query
 from tortoise.contrib.fastapi import register_tortoise
+from database import TORTOISE_ORM, GENERATE_SCHEMAS
 from models import *
 import os
 
 #logging
 import logging
+import logs
 
-logging.basicConfig(
-    level=logging.INFO,  # Change to DEBUG for more verbosity
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    filename="app.log",         # Log file path/name
-    filemode="a"                # Append to the log file (use "w" to overwrite each time)
-)
+# JSON lines to LOG_FILE (app.log) written off the event loop, see logs.py
+logs.setup_logging()
 
 logger = logging.getLogger(__name__)
 
@@ -25,46 +23,94 @@ from tortoise.signals import post_save
 from typing import List, Optional, Type
 from tortoise import BaseDBAsyncClient
 from tortoise.exceptions import IntegrityError
-from mail import send_email
+from mail import send_email, outbox
+
+#rate limiting
+from ratelimit import rate_limiter
 
 #image uplaod
 from fastapi import File, UploadFile
-import secrets
 from fastapi.staticfiles import StaticFiles
-from PIL import Image
+from images import store_upload, variant_names, image_url, image_pipeline, UploadLimitMiddleware, ImageFiles, IMAGE_DIR
 
 #response classes
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse
+from encoding import OrjsonResponse, OrjsonRoute
+
+#metrics
+import metrics
+from metrics import span
+from tortoise import connections
+
+#response cache
+from cache import cached_json, invalidate_product, invalidate_business, response_cache
+
+#bulk import/export
+from bulk import detect_format, parse_rows, import_products, export_products
+
+#search
+from search import search_products, ensure_search_index, MAX_SEARCH_RESULTS
+
+#offer expiry
+from expiry import offer_active, expiry_scheduler, ensure_expiry_schema
+
+#seller dashboard
+from dashboard import business_stats, ensure_stats_triggers
+
+#change feed
+from changes import change_feed, check_cursor, fetch_changes, latest_change, ensure_change_triggers
+
+#deals
+from price_index import price_index, find_deals, SORTS
+
+#catalog
+from catalog import (DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, parse_fields, filter_products,
+                     fetch_page, stream_products, parse_ids, fetch_product_details)
+from decimal import Decimal
 
 #datetime
 from datetime import datetime
-app = FastAPI()
-
-#templates
-from fastapi.templating import Jinja2Templates
+# endpoint results are encoded by orjson, pydantic models straight to bytes, see encoding.py
+app = FastAPI(default_response_class = OrjsonResponse)
+app.router.route_class = OrjsonRoute
 
 oath2_scheme = OAuth2PasswordBearer(tokenUrl = "token")
 
 # static file setup config
 #becomes available by http://localhost:8000/static/images/logo.png
 #improve for security purposes
+# images first: content-hashed names are served with long-lived cache headers (or offloaded)
+app.mount("/static/images", ImageFiles(directory=IMAGE_DIR), name="images")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# upload bodies over MAX_UPLOAD_SIZE are refused before they are read
+app.add_middleware(UploadLimitMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+# outermost, so the request id covers every other middleware and the logged duration too
+app.add_middleware(logs.RequestLogMiddleware)
+
 @app.post("/token", include_in_schema=False)
-async def generate_token(request_form: OAuth2PasswordRequestForm = Depends()):
+async def generate_token(request: Request, request_form: OAuth2PasswordRequestForm = Depends()):
     #LOG generating token
-    logger.info(f"Login attempt for user: {request_form.username}")
-    token = await token_generator(request_form.username, request_form.password)
+    logger.info("Login attempt for user: %s", request_form.username)
+    # refused before the bcrypt verify runs
+    await rate_limiter.check_login(request, request_form.username)
+    try:
+        token = await token_generator(request_form.username, request_form.password)
+    except HTTPException:
+        await rate_limiter.failed_login(request_form.username)
+        raise
     return {"access_token": token, "token_type": "bearer"}
 
 async def get_current_user(token: str = Depends(oath2_scheme)):
     try:
-        payload = jwt.decode(token, config_credentials["SECRET"], algorithms=["HS256"])
-        logger.debug(f"Token payload decoded for user ID: {payload.get('id')}")
-        user = await User.get(id = payload.get("id"))
+        with span("auth"):
+            payload = decode_access_token(token)
+            logger.debug("Token payload decoded for user ID: %s", payload.get('id'))
+            user = await get_user_by_id(payload["id"])
     
     except Exception as e:
-        logger.warning(f"Invalid token access attempt: {e}")
+        logger.warning("Invalid token access attempt: %s", e)
         raise HTTPException(
             status_code = status.HTTP_401_UNAUTHORIZED,
             detail = "Invalid username or password",
@@ -72,11 +118,29 @@ async def get_current_user(token: str = Depends(oath2_scheme)):
         )
     return user
 
+# read-only ownership checks only need the id, skip the user lookup entirely when the claims are trusted.
+# Writes use get_current_user, a deleted user must not keep writing until the token expires
+async def get_current_identity(token: str = Depends(oath2_scheme)):
+    if not TRUST_TOKEN_CLAIMS:
+        return await get_current_user(token)
+
+    try:
+        with span("auth"):
+            payload = decode_access_token(token)
+    except Exception as e:
+        logger.warning("Invalid token access attempt: %s", e)
+        raise HTTPException(
+            status_code = status.HTTP_401_UNAUTHORIZED,
+            detail = "Invalid username or password",
+            headers = {"WWW-AUTHENTICATE": "Bearer"}
+        )
+    return TokenUser(id = payload["id"], username = payload.get("username"))
+
 @app.post("/user/me")
 async def user_login(user: user_pydanticIn = Depends(get_current_user)):
     business = await Business.get(owner = user)
     logo = business.logo
-    logo_path = "localhost:8000/static/images/"+logo
+    logo_path = image_url(logo)
 
 
     return {
@@ -112,8 +176,10 @@ async def create_business(
 
 @app.post("/registration")
 # LOG registration process started
-async def user_registration(user: user_pydanticIn):
-    logger.info(f"Registration attempt for username: {user.username}, email: {user.email}")
+async def user_registration(user: user_pydanticIn, request: Request):
+    logger.info("Registration attempt for username: %s, email: %s", user.username, user.email)
+    # refused before any write, the verification email is sent from the User post_save signal
+    await rate_limiter.check_registration(request)
     user_info = user.dict(exclude_unset=True)
 
     # LOG Optional pre-check(username)
@@ -124,13 +190,13 @@ async def user_registration(user: user_pydanticIn):
         raise HTTPException(status_code=400, detail="Email already exists")
 
     # Hash the password
-    user_info["password"] = get_hashed_password(user_info["password"])
+    user_info["password"] = await get_hashed_password(user_info["password"])
 
     try:
         # LOG Create user and save
         user_obj = await User.create(**user_info)
         new_user = await user_pydantic.from_tortoise_orm(user_obj)
-        logger.info(f"User created: {new_user.username}")
+        logger.info("User created: %s", new_user.username)
     except IntegrityError as e:
         raise HTTPException(status_code=400, detail="Username or Email already exists")
 
@@ -143,24 +209,33 @@ async def user_registration(user: user_pydanticIn):
     }
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
+# Jinja2 is only needed by the verification pages, it is loaded on the first one
+_templates = None
+
+def get_templates():
+    global _templates
+    if _templates is None:
+        from fastapi.templating import Jinja2Templates
+        _templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
+    return _templates
+
 @app.get("/verification", response_class=HTMLResponse)
 # LOG verification starting
 async def email_verification(request: Request, token: str): #what is request
-    logger.info(f"Verification attempt with token")
+    logger.info("Verification attempt with token")
     user = await very_token(token)
     if user:
         if user.is_verified:
             # LOG already verified, return a message indicating they are already verified
-            logger.info(f"User {user.username} already verified ")
-            return templates.TemplateResponse("already_verified.html", 
+            logger.info("User %s already verified ", user.username)
+            return get_templates().TemplateResponse("already_verified.html", 
                                               {"request": request, "username": user.username})
         else:
             # LOG user was not verified, verify the user
             user.is_verified = True
             await user.save()
-            logger.info(f"User {user.username} verified successfully")
-            return templates.TemplateResponse("verification.html", 
+            logger.info("User %s verified successfully", user.username)
+            return get_templates().TemplateResponse("verification.html", 
                                               {"request": request, "username": user.username})
     #LOG error
     raise HTTPException(
@@ -176,98 +251,121 @@ async def email_verification(request: Request, token: str): #what is request
 def index():
     return {"Message": "Hello World"}
 
+# queue depths and counters of the background worker pools
+@app.get("/stats", include_in_schema=False)
+async def get_stats():
+    return {
+        "status": "ok",
+        "data": {
+            "password_hashing": hash_pool.stats(),
+            "user_cache": user_cache.stats(),
+            "email_outbox": {**outbox.stats(), "pending": await outbox.pending()},
+            "image_processing": image_pipeline.stats(),
+            "response_cache": response_cache.stats(),
+            "logging": logs.stats(),
+            "offer_expiry": expiry_scheduler.stats(),
+            "rate_limiting": rate_limiter.stats(),
+            "change_feed": change_feed.stats(),
+            "price_index": price_index.stats()
+        }
+    }
+
+metrics.register_gauges("password_hashing", hash_pool.stats)
+metrics.register_gauges("user_cache", user_cache.stats)
+metrics.register_gauges("email_outbox", outbox.stats)
+metrics.register_gauges("image_processing", image_pipeline.stats)
+metrics.register_gauges("response_cache", response_cache.stats)
+metrics.register_gauges("logging", logs.stats)
+metrics.register_gauges("offer_expiry", expiry_scheduler.stats)
+metrics.register_gauges("rate_limiting", rate_limiter.stats)
+metrics.register_gauges("change_feed", change_feed.stats)
+metrics.register_gauges("price_index", price_index.stats)
+
+# Prometheus scrape target
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type = "text/plain; version=0.0.4")
+
+@app.on_event("startup")
+async def start_workers():
+    if GENERATE_SCHEMAS:
+        await ensure_expiry_schema()
+        await ensure_search_index()
+        await ensure_stats_triggers()
+        await ensure_change_triggers()
+    await outbox.start()
+    await expiry_scheduler.start()
+    await change_feed.start()
+    # loads in the background, deals are read from the database until it is ready
+    await price_index.start()
+    metrics.instrument_db(type(connections.get("default")))
+    if metrics.profiler is not None:
+        metrics.profiler.start()
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    await price_index.stop()
+    await change_feed.stop()
+    await expiry_scheduler.stop()
+    await outbox.stop()
+    await image_pipeline.shutdown()
+    hash_pool.shutdown()
+    if metrics.profiler is not None:
+        metrics.profiler.stop()
+    logs.stop_logging()
+
 #LOG upload pictures
 @app.post("/uploadfile/profile")
 async def create_upload_file(file: UploadFile = File(...), user: user_pydantic = Depends(get_current_user)):
-    logger.info(f"User {user.username} uploading profile image: {file.filename}")
-    FILEPATH = "./static/images/"
-    filename = file.filename
-    extension = filename.split(".")[1]
-
-    if extension not in ["png", "jpg"]:
-        return {"status": "error", "detail": "File extension not allowed"}
-    
-    token_name = secrets.token_hex(10)+"."+extension
-    generated_name = FILEPATH + token_name
-    file_content = await file.read()
+    logger.info("User %s uploading profile image: %s", user.username, file.filename)
+    business = await Business.get(owner_id = user.id)
 
-    #LOG image is saving
-    with open(generated_name, "wb") as file:
-        file.write(file_content)
+    #LOG image is saving, resized variants are generated in the background
+    with span("image_upload"):
+        token_name = await store_upload(file)
+    logger.info("Image saved")
 
-    # PILLOW
-    img = Image.open(generated_name)
-    img = img.resize(size = (200, 200))
-    img.save(generated_name)
+    business.logo = token_name
+    await business.save(update_fields = ["logo"])
+    await invalidate_business(business.id)
 
-    file.close()
-    logger.info(f"Image saved")
+    file_url = image_url(token_name)
+    return {"status": "ok", "filename": file_url, "variants": variant_names(token_name)}
 
-    business = await Business.get(owner = user) #shouldnt it be before saving image?
-    owner = await business.owner
-
-    if owner == user:
-        business.logo = token_name
-        await business.save()
+@app.post("/uploadfile/product/{id}")
+async def create_upload_file(id: int, file: UploadFile = File(...), user: user_pydantic = Depends(get_current_user)):
+    product = await Product.get(id = id).select_related("business_owner")
 
-    else:
+    if product.business_owner.owner_id != user.id:
         raise HTTPException(
             status_code = status.HTTP_401_UNAUTHORIZED,
             detail = "Not authenticated to perform this acton",
             headers = {"WWW-Authenticate": "Bearer"}
         )
-    file_url = "localhost:8000"+generated_name[1:]
-    return {"status": "ok", "filename": file_url}
-
-@app.post("/uploadfile/product/{id}")
-async def create_upload_file(id: int, file: UploadFile = File(...), user: user_pydantic = Depends(get_current_user)):
-    FILEPATH = "./static/images/"
-    filename = file.filename
-    extension = filename.split(".")[1]
-
-    if extension not in ["png", "jpg"]:
-        return {"status": "error", "detail": "File extension not allowed"}
-    
-    token_name = secrets.token_hex(10)+"."+extension
-    generated_name = FILEPATH + token_name
-    file_content = await file.read()
-
-    with open(generated_name, "wb") as file:
-        file.write(file_content)
-
-    # PILLOW
-    img = Image.open(generated_name)
-    img = img.resize(size = (200, 200))
-    img.save(generated_name)
 
-    file.close()
+    with span("image_upload"):
+        token_name = await store_upload(file)
 
-    product = await Product.get(id = id)
-    business = await product.business_owner
-    owner = await business.owner
+    product.product_image = token_name
+    await product.save(update_fields = ["product_image"])
+    await invalidate_product(id)
 
-    if owner == user:
-        product.product_image = token_name
-        await product.save()
-
-    else:
-        raise HTTPException(
-            status_code = status.HTTP_401_UNAUTHORIZED,
-            detail = "Not authenticated to perform this acton",
-            headers = {"WWW-Authenticate": "Bearer"}
-        )
+    file_url = image_url(token_name)
+    return {"status": "ok", "filename": file_url, "variants": variant_names(token_name)}
 
 # CRUD functionality
 
 @app.post("/products")
 async def add_new_product(product: product_pydanticIn, user: user_pydantic = Depends(get_current_user)):
-    logger.info(f"New product being added by user: {user.username}")
+    logger.info("New product being added by user: %s", user.username)
     product = product.dict(exclude_unset = True)
     if product["original_price"] > 0:
         product["percentage_discount"] = ((product["original_price"] - product["new_price"])
                                           / product["original_price"]) * 100
-        business = await Business.get(owner=user)
+        product["active"] = offer_active(product.get("offer_expiration_date"))
+        business = await Business.get(owner_id=user.id)
         product_obj = await Product.create(**product, business_owner=business)
+        await invalidate_product()
 
         product_obj = await product_pydantic.from_tortoise_orm(product_obj)
 
@@ -278,47 +376,158 @@ async def add_new_product(product: product_pydanticIn, user: user_pydantic = Dep
         return {"status": "error"}
     
 
+@app.post("/products/bulk")
+async def bulk_import_products(request: Request, format: Optional[str] = None, user: user_pydantic = Depends(get_current_user)):
+    # CSV (with a header row) or NDJSON body, parsed and inserted while it streams in
+    format = detect_format(format, request.headers.get("content-type"))
+    logger.info("Bulk %s import started by user: %s", format, user.username)
+    business = await Business.get(owner_id = user.id)
+    return await import_products(parse_rows(request.stream(), format), business.id, on_chunk = invalidate_product)
+
+
+@app.get("/products/export")
+async def bulk_export_products(format: str = "ndjson", category: Optional[str] = None, user: user_pydantic = Depends(get_current_identity)):
+    format = detect_format(format, None)
+    business = await Business.get(owner_id = user.id)
+    queryset = filter_products(category, active = None).filter(business_owner_id = business.id)
+    return StreamingResponse(
+        export_products(queryset, format),
+        media_type = "text/csv" if format == "csv" else "application/x-ndjson",
+        headers = {"Content-Disposition": f'attachment; filename="products.{format}"'}
+    )
+
+
 @app.get("/product")
-async def get_product():
-    response = await product_pydantic.from_queryset(Product.all())
+async def get_product(
+    request: Request,
+    cursor: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    category: Optional[str] = None,
+    min_price: Optional[Decimal] = None,
+    max_price: Optional[Decimal] = None,
+    min_discount: Optional[int] = None,
+    max_discount: Optional[int] = None,
+    fields: Optional[str] = None,
+    stream: bool = False,
+    ids: Optional[str] = None
+):
+    # batch lookup, product and business details for every id in a single query
+    if ids is not None:
+        requested = parse_ids(ids)
+
+        async def build_details():
+            response = await fetch_product_details(requested)
+            return {"status": "ok", "data": response}
+
+        return await cached_json(
+            request, "products:" + ",".join(map(str, requested)), build_details,
+            lambda content: ["catalog"] + [f"business:{item['business_details']['business_id']}" for item in content["data"]]
+        )
+
+    selected = parse_fields(fields)
+    queryset = filter_products(category, min_price, max_price, min_discount, max_discount)
+
+    # NDJSON mode sends every matching row in chunks, capped only by an explicit limit
+    if stream:
+        return StreamingResponse(
+            stream_products(queryset, selected, cursor, limit),
+            media_type = "application/x-ndjson"
+        )
+
+    async def build_page():
+        page_size = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        response, next_cursor = await fetch_page(queryset, selected, cursor, page_size)
+        return {"status": "ok", "data": response, "next_cursor": next_cursor}
+
+    key = "catalog:" + "&".join(sorted(f"{name}={value}" for name, value in request.query_params.multi_items()))
+    return await cached_json(request, key, build_page, lambda content: ["catalog"])
+
+
+# biggest discounts (or lowest prices) in a category and price range, answered from the in-memory
+# price index. Declared before /product/{id}
+@app.get("/product/deals")
+async def get_deals(
+    category: Optional[str] = None,
+    min_price: Optional[Decimal] = None,
+    max_price: Optional[Decimal] = None,
+    min_discount: Optional[int] = None,
+    sort: str = Query("discount", pattern = "^(" + "|".join(SORTS) + ")$"),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None
+):
+    response = await find_deals(category, min_price, max_price, min_discount, sort, limit, parse_fields(fields))
     return {"status": "ok", "data": response}
 
 
-@app.get("/product/{id}")
-async def get_product(id: int):
-    product = await Product.get(id=id)
-    business = await product.business_owner
-    owner = await business.owner
-    response = await product_pydantic.from_queryset_single(product.get(id=id))
+# deltas for clients that keep a copy of the catalog, declared before /product/{id}.
+# Without since it only returns the latest cursor to follow from after a full load
+@app.get("/product/changes")
+async def get_product_changes(since: Optional[int] = Query(None, ge=0), limit: Optional[int] = Query(None, ge=1)):
+    if since is None:
+        return {"status": "ok", "data": [], "next_cursor": await latest_change(), "has_more": False}
+    await check_cursor(since)
+    return await fetch_changes(since, min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE))
+
+
+# the same changes as Server-Sent Events, reconnecting clients resume from Last-Event-ID
+@app.get("/product/changes/stream")
+async def stream_product_changes(request: Request, since: Optional[int] = Query(None, ge=0)):
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    if since is None:
+        since = await latest_change()
+    await check_cursor(since)
+    return StreamingResponse(
+        change_feed.stream(since),
+        media_type = "text/event-stream",
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-    return {
-        "status": "ok",
-        "data": {
-            "product_details": response,
-            "business_details": {
-                "name": business.business_name,
-                "city": business.city,
-                "region": business.region,
-                "description": business.business_description,
-                "logo": business.logo,
-                "owner_id": owner.id,
-                "business_id": business.id,
-                "email": owner.email,
-                "join_date": owner.join_date.strftime("%b %d %Y")
-            }
-        }
-    }
+
+@app.get("/product/{id}")
+async def get_product(id: int, request: Request):
+    async def build_detail():
+        response = await fetch_product_details([id])
+        if not response:
+            raise HTTPException(
+                status_code = status.HTTP_404_NOT_FOUND,
+                detail = "Product not found"
+            )
+        return {"status": "ok", "data": response[0]}
+
+    return await cached_json(
+        request, f"product:{id}", build_detail,
+        lambda content: [f"product:{id}", f"business:{content['data']['business_details']['business_id']}"]
+    )
+
+
+@app.get("/search")
+async def search(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200),
+    category: Optional[str] = None,
+    city: Optional[str] = None,
+    region: Optional[str] = None,
+    min_discount: Optional[int] = None,
+    limit: int = Query(20, ge=1, le=MAX_SEARCH_RESULTS),
+    offset: int = Query(0, ge=0)
+):
+    async def build_results():
+        return await search_products(q, category, city, region, min_discount, limit, offset)
+
+    key = "search:" + "&".join(sorted(f"{name}={value}" for name, value in request.query_params.multi_items()))
+    return await cached_json(request, key, build_results, lambda content: ["catalog", "search"])
 
 
 @app.delete("/product/{id}")
 async def delete_product(id: int, user: user_pydantic = Depends(get_current_user)):
-    logger.info(f"Delete attempt for product ID {id} by user {user.username}")
-    product = await Product.get(id=id)
-    business = await product.business_owner
-    owner = await business.owner
+    logger.info("Delete attempt for product ID %s by user %s", id, user.username)
+    product = await Product.get(id=id).select_related("business_owner")
     
-    if user == owner:
+    if product.business_owner.owner_id == user.id:
         await product.delete()
+        await invalidate_product(id)
         #return {"status": "YAYA"}
     else:
         raise HTTPException(
@@ -332,19 +541,20 @@ async def delete_product(id: int, user: user_pydantic = Depends(get_current_user
 
 @app.put("/product/{id}")
 async def update_product(id: int, update_info: product_pydanticIn, user: user_pydantic = Depends(get_current_user)):
-    logger.info(f"Update attempt on product ID {id} by user {user.username}")
-    product = await Product.get(id=id)
-    business = await product.business_owner
-    owner = await business.owner
+    logger.info("Update attempt on product ID %s by user %s", id, user.username)
+    product = await Product.get(id=id).select_related("business_owner")
 
     update_info = update_info.dict(exclude_unset=True)
     update_info["date_published"] = datetime.utcnow()
 
-    if user == owner and update_info["original_price"] > 0:
+    if product.business_owner.owner_id == user.id and update_info["original_price"] > 0:
         update_info["percentage_discount"] = ((update_info["original_price"] - update_info["new_price"])
                                               / update_info["original_price"]) * 100
+        # extending an expired offer puts it back in the catalog
+        update_info["active"] = offer_active(update_info.get("offer_expiration_date", product.offer_expiration_date))
         product = await product.update_from_dict(update_info)
         await product.save()
+        await invalidate_product(id)
         response = await product_pydantic.from_tortoise_orm(product)
         return {"status": "ok", "data": response}
     else:
@@ -357,14 +567,14 @@ async def update_product(id: int, update_info: product_pydanticIn, user: user_py
 
 @app.post("/business/{id}")
 async def update_business(id: int, update_business: business_pydanticIn, user: user_pydantic=Depends(get_current_user)):
-    logger.info(f"Business update request for business ID {id} by user {user.username}")
+    logger.info("Business update request for business ID %s by user %s", id, user.username)
     update_business = update_business.dict()
     business = await Business.get(id=id)
-    business_owner = await business.owner
 
-    if user == business_owner:
+    if business.owner_id == user.id:
         await business.update_from_dict(update_business)
-        business.save()
+        await business.save()
+        await invalidate_business(id)
         response = await business_pydantic.from_tortoise_orm(business)
         return {"status": "ok", "data": response}
     
@@ -375,14 +585,27 @@ async def update_business(id: int, update_business: business_pydanticIn, user: u
             headers = {"WWW-Authenticate": "Bearer"}
         )
 
+# seller dashboard, served from the per business aggregate rows
+@app.get("/business/{id}/stats")
+async def get_business_stats(id: int, user: user_pydantic = Depends(get_current_identity)):
+    business = await Business.get(id=id)
+
+    if business.owner_id != user.id:
+        raise HTTPException(
+            status_code = status.HTTP_401_UNAUTHORIZED,
+            detail = "Not authenticated to perform this acton",
+            headers = {"WWW-Authenticate": "Bearer"}
+        )
+
+    return {"status": "ok", "data": await business_stats(id)}
+
 
 
 
 register_tortoise(
     app,
-    db_url = "sqlite://database.sqlite3",
-    modules = {"models": ["models"]},
-    generate_schemas = True,
+    config = TORTOISE_ORM,
+    generate_schemas = GENERATE_SCHEMAS,    # run "python database.py migrate" instead
     add_exception_handlers = True
 
 )
\ No newline at end of file
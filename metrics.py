@@ -0,0 +1,302 @@
+"""Prometheus text format metrics for requests, ORM queries and the slow stages behind them.
+
+Scraped from GET /metrics. Request latency and the number and time of the
+ORM queries each request made are recorded per route template, so an N+1
+regression shows up as a jump in ``db_queries_per_request`` for one route.
+``span`` times the stages inside a request (auth, bcrypt, image work, SMTP)
+and the worker pool and queue depths are read from their ``stats()`` at
+scrape time.
+
+With PROFILE_SLOW_MS set, a sampling profiler records the event loop thread
+and every request slower than that leaves a folded stack file in PROFILE_DIR,
+ready for flamegraph.pl or speedscope.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import deque
+from dotenv import dotenv_values
+from typing import Callable, Dict, Iterable, Tuple
+import asyncio
+import functools
+import os
+import re
+import sys
+import threading
+import time
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+config_credentials = dotenv_values(".env")
+
+# requests slower than this are profiled, 0 disables the profiler
+PROFILE_SLOW_MS = float(config_credentials.get("PROFILE_SLOW_MS") or 0)
+PROFILE_DIR = config_credentials.get("PROFILE_DIR") or "./profiles/"
+PROFILE_INTERVAL_MS = float(config_credentials.get("PROFILE_INTERVAL_MS") or 5)
+# seconds of samples kept in memory, requests longer than this are only profiled in part
+PROFILE_WINDOW = 60
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}   # labels -> [count per bucket, sum, count]
+
+    def observe(self, value: float, *labels):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][index] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labels + ("le",)
+        for labels, (buckets, total, count) in self._values.items():
+            cumulative = 0
+            for bound, hits in zip(self.buckets, buckets):
+                cumulative += hits
+                yield f"{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {count}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {count}"
+
+
+REQUESTS = Counter("http_requests_total", "Requests by route and status code", ("method", "route", "status"))
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Request latency by route", ("method", "route"))
+REQUEST_QUERIES = Histogram(
+    "db_queries_per_request", "ORM queries issued per request", ("method", "route"), buckets = QUERY_COUNT_BUCKETS
+)
+REQUEST_DB_SECONDS = Histogram("db_time_per_request_seconds", "Time spent in ORM queries per request", ("method", "route"))
+QUERY_SECONDS = Histogram("db_query_duration_seconds", "ORM query latency by client call", ("call",))
+SPAN_SECONDS = Histogram("span_duration_seconds", "Time spent in instrumented stages", ("span",))
+
+METRICS = [REQUESTS, REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_DB_SECONDS, QUERY_SECONDS, SPAN_SECONDS]
+# name -> callable returning a stats dict, exported as gauges on every scrape
+GAUGE_SOURCES: Dict[str, Callable[[], dict]] = {}
+in_progress = 0
+
+
+def register_gauges(name: str, source: Callable[[], dict]):
+    GAUGE_SOURCES[name] = source
+
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    lines.append("# TYPE http_requests_in_progress gauge")
+    lines.append(f"http_requests_in_progress {in_progress}")
+    for source, stats in GAUGE_SOURCES.items():
+        for key, value in stats().items():
+            # numbers only, settings such as the pool kind are strings
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = re.sub(r"\W", "_", f"{source}_{key}")
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def span(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAN_SECONDS.observe(time.perf_counter() - started, name)
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+current_request = ContextVar("current_request", default = None)
+# set while a client call runs, so a method that calls another is counted once
+_in_query = ContextVar("in_query", default = False)
+
+DB_CALLS = ("execute_query", "execute_query_dict", "execute_insert", "execute_many", "execute_script")
+
+
+def _timed_query(call: str, method):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        if _in_query.get():
+            return await method(*args, **kwargs)
+        token = _in_query.set(True)
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            _in_query.reset(token)
+            QUERY_SECONDS.observe(elapsed, call)
+            stats = current_request.get()
+            if stats is not None:
+                stats.queries += 1
+                stats.db_seconds += elapsed
+
+    wrapper._metrics_wrapped = True
+    return wrapper
+
+
+def instrument_db(client_class: type):
+    """Time every query of a Tortoise client class, transaction wrappers included."""
+    classes = list(client_class.__mro__)
+    for klass in classes:
+        # the backend's transaction wrapper subclasses the client and overrides some calls
+        if issubclass(klass, client_class):
+            classes.extend(sub for sub in klass.__subclasses__() if sub not in classes)
+        for call in DB_CALLS:
+            method = vars(klass).get(call)
+            if method is not None and not getattr(method, "_metrics_wrapped", False):
+                setattr(klass, call, _timed_query(call, method))
+
+
+class SlowRequestProfiler:
+    """Samples the event loop thread's stack and keeps a short rolling window of samples."""
+
+    def __init__(self, threshold_ms: float, interval_ms: float, directory: str):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.directory = directory
+        self.dumps = 0
+        self._samples = deque(maxlen = int(PROFILE_WINDOW / self.interval))
+        self._thread = None
+        self._target = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        # called from the event loop thread, which is the one sampled
+        if self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok = True)
+        self._target = threading.get_ident()
+        self._stopped.clear()
+        self._thread = threading.Thread(target = self._sample, name = "profiler", daemon = True)
+        self._thread.start()
+        logger.info("Profiling requests slower than %sms into %s", self.threshold * 1000, self.directory)
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self._samples.append((time.perf_counter(), ";".join(reversed(stack))))
+
+    async def record(self, started: float, elapsed: float, name: str):
+        """Write the samples taken during a slow request as folded stacks."""
+        if self._thread is None or elapsed < self.threshold:
+            return
+        # the loop runs other requests meanwhile, their frames are part of the picture too
+        counts = {}
+        for taken, stack in list(self._samples):
+            if started <= taken <= started + elapsed:
+                counts[stack] = counts.get(stack, 0) + 1
+        if not counts:
+            return
+        slug = re.sub(r"[^\w.-]", "_", name)
+        path = os.path.join(self.directory, f"{int(time.time() * 1000)}_{slug}.folded")
+        body = "".join(f"{stack} {count}\n" for stack, count in counts.items())
+        await asyncio.to_thread(_write, path, body)
+        self.dumps += 1
+        logger.warning("Slow request %s took %.0fms, profile written to %s", name, elapsed * 1000, path)
+
+
+def _write(path: str, body: str):
+    with open(path, "w") as file:
+        file.write(body)
+
+
+profiler = SlowRequestProfiler(PROFILE_SLOW_MS, PROFILE_INTERVAL_MS, PROFILE_DIR) if PROFILE_SLOW_MS else None
+
+
+class MetricsMiddleware:
+    """Records latency, status and ORM usage of every request under its route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        global in_progress
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_progress += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_progress -= 1
+            current_request.reset(token)
+
+            # the router stores the matched route in the scope, unmatched paths share one label
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope["method"]
+            REQUESTS.inc(method, route, status_code)
+            REQUEST_SECONDS.observe(elapsed, method, route)
+            REQUEST_QUERIES.observe(stats.queries, method, route)
+            REQUEST_DB_SECONDS.observe(stats.db_seconds, method, route)
+            if profiler is not None:
+                await profiler.record(started, elapsed, f"{method} {route}")
@@ -34,10 +34,99 @@ class Product(Model):
     new_price = fields.DecimalField(max_digits=12, decimal_places=2)
     percentage_discount = fields.IntField()
     offer_expiration_date = fields.DateField(default=datetime.utcnow)
+    active = fields.BooleanField(default=True) # false once the offer has expired, indexed in expiry.py
     product_image = fields.CharField(max_length=200, null=False, default="productDefault.jpg")
     business_owner = fields.ForeignKeyField("models.Business", related_name="products")
 
 
+class BusinessOfferStats(Model):
+    # products and summed discounts per business and expiry day, maintained by triggers (dashboard.py)
+    id = fields.IntField(pk=True)
+    business = fields.ForeignKeyField("models.Business", related_name="offer_stats")
+    expires_on = fields.DateField()
+    products = fields.IntField(default=0)
+    discount_total = fields.BigIntField(default=0)
+
+    class Meta:
+        table = "business_offer_stats"
+        unique_together = (("business", "expires_on"),)
+
+
+class ProductChange(Model):
+    # change feed entry, appended by triggers on every product write (changes.py), the id is the consumers' cursor
+    id = fields.BigIntField(pk=True)
+    product_id = fields.IntField() # no foreign key, entries outlive deleted products
+    operation = fields.CharField(max_length=6) # insert, update, delete
+    changed_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "product_change"
+
+
+class BusinessChange(Model):
+    # appended by triggers on every business update or delete (changes.py), tells each worker which cached product details to drop
+    id = fields.BigIntField(pk=True)
+    business_id = fields.IntField()
+    changed_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "business_change"
+
+
+class ResponseCacheEntry(Model):
+    # response body of cache.DatabaseCache, the cache shared by every worker
+    key = fields.CharField(max_length=32, pk=True) # blake2b of the cache key, keys can be longer than an index allows
+    body = fields.BinaryField()
+    etag = fields.CharField(max_length=40)
+    expires_at = fields.FloatField(index=True) # unix time
+
+    class Meta:
+        table = "response_cache_entry"
+
+
+class ResponseCacheEntryTag(Model):
+    # the tags of a cached response, an invalidated tag drops the entries listed under it
+    id = fields.BigIntField(pk=True)
+    key = fields.CharField(max_length=32, index=True)
+    tag = fields.CharField(max_length=64, index=True)
+
+    class Meta:
+        table = "response_cache_entry_tag"
+
+
+class ResponseCacheTag(Model):
+    # generation of each tag's last invalidation, the row with the empty tag is the generation counter
+    tag = fields.CharField(max_length=64, pk=True)
+    generation = fields.BigIntField(default=0)
+
+    class Meta:
+        table = "response_cache_tag"
+
+
+class RateLimitBucket(Model):
+    # token bucket of ratelimit.DatabaseBuckets, stored as the time it will be full again
+    key = fields.CharField(max_length=255, pk=True)
+    full_at = fields.FloatField(index=True) # unix time
+
+    class Meta:
+        table = "rate_limit_bucket"
+
+
+class EmailJob(Model):
+    # outbox row, written in the request and delivered later by the mail workers
+    id = fields.IntField(pk=True, index=True)
+    recipients = fields.JSONField()
+    subject = fields.CharField(max_length=200)
+    body = fields.TextField()
+    subtype = fields.CharField(max_length=10, default="html")
+    status = fields.CharField(max_length=10, default="pending", index=True) # pending, sent, failed
+    attempts = fields.IntField(default=0)
+    version = fields.IntField(default=0) # bumped on every claim, guards against two workers taking one job
+    next_attempt_at = fields.DatetimeField(default=datetime.utcnow, index=True)
+    last_error = fields.TextField(null=True)
+    created_at = fields.DatetimeField(default=datetime.utcnow)
+
+
 # Pydantic Schemas
 user_pydantic = pydantic_model_creator(User, name="User", exclude=("is_verified",))
 user_pydanticIn = pydantic_model_creator(User, name="UserIn", exclude_readonly=True, exclude=("is_verified", "join_date"))
@@ -47,7 +136,7 @@ business_pydantic = pydantic_model_creator(Business, name="Business")
 business_pydanticIn = pydantic_model_creator(Business, name="BusinessIn", exclude_readonly=True)
 
 product_pydantic = pydantic_model_creator(Product, name="Product")
-product_pydanticIn = pydantic_model_creator(Product, name="ProductIn", exclude=("percentage_discount", "id"))
+product_pydanticIn = pydantic_model_creator(Product, name="ProductIn", exclude=("percentage_discount", "id", "active"))
 
 
 
@@ -0,0 +1,296 @@
+from tortoise.expressions import RawSQL
+from dotenv import dotenv_values
+from decimal import Decimal
+from typing import Dict, List, Optional
+from catalog import filter_products, serialize_row
+from changes import latest_change
+from models import Product, ProductChange
+import asyncio
+import time
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+config_credentials = dotenv_values(".env")
+
+PRICE_INDEX_ENABLED = (config_credentials.get("PRICE_INDEX_ENABLED") or "true").lower() in ("1", "true", "yes")
+# how often the index applies new entries of the product change feed, the most it lags behind writes
+PRICE_INDEX_INTERVAL = float(config_credentials.get("PRICE_INDEX_INTERVAL") or 1)
+# rows per query while loading, and change feed entries per refresh step
+LOAD_CHUNK_SIZE = 10000
+
+SORTS = ("discount", "price")
+
+# numpy, imported by the first load so that importing main stays fast (serve.py loads it before
+# forking). Partitions are only built by load and refresh, and queried once ready, after it
+np = None
+
+
+def _import_numpy():
+    global np
+    import numpy as np
+
+
+def to_cents(price) -> int:
+    return int((Decimal(price) * 100).to_integral_value())
+
+
+class Partition:
+    """The active products of one category as parallel numpy columns.
+
+    Rows are kept sorted by id so a changed product is found by binary search.
+    by_discount and by_price hold row positions in query order, prices_sorted
+    the prices in by_price order for range lookups: 32 bytes per product.
+    """
+
+    __slots__ = ("ids", "prices", "discounts", "by_discount", "by_price", "prices_sorted")
+
+    def __init__(self, ids, prices, discounts):
+        ids = np.asarray(ids, dtype = np.int32)
+        order = np.argsort(ids, kind = "stable")
+        self.ids = ids[order]
+        self.prices = np.asarray(prices, dtype = np.int64)[order]
+        # percentage_discount is not bounded, a new price above the original makes it negative
+        self.discounts = np.asarray(discounts, dtype = np.int32)[order]
+        # highest discount first and cheapest first, ties by id so results are stable
+        self.by_discount = np.lexsort((self.ids, -self.discounts.astype(np.int64))).astype(np.int32)
+        self.by_price = np.lexsort((self.ids, self.prices)).astype(np.int32)
+        self.prices_sorted = self.prices[self.by_price]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, column).nbytes for column in self.__slots__)
+
+    def contains(self, ids):
+        """Mask over ``ids`` (a sorted array) of those stored here."""
+        positions = np.minimum(np.searchsorted(self.ids, ids), max(len(self.ids) - 1, 0))
+        return self.ids[positions] == ids if len(self.ids) else np.zeros(len(ids), dtype = bool)
+
+    def replace(self, removed, added: List[tuple]) -> "Partition":
+        # a new partition, queries running on the old one are not disturbed
+        keep = ~np.isin(self.ids, removed, assume_unique = True)
+        return Partition(
+            np.concatenate([self.ids[keep], np.array([row[0] for row in added], dtype = np.int32)]),
+            np.concatenate([self.prices[keep], np.array([row[1] for row in added], dtype = np.int64)]),
+            np.concatenate([self.discounts[keep], np.array([row[2] for row in added], dtype = np.int32)])
+        )
+
+    def query(self, min_cents: Optional[int], max_cents: Optional[int], min_discount: Optional[int], sort: str, limit: int):
+        """(ids, sort keys) of the first ``limit`` matches in ``sort`` order."""
+        if sort == "discount" and min_cents is None and max_cents is None:
+            rows = self.by_discount[:limit]
+            if min_discount is not None:
+                rows = rows[self.discounts[rows] >= min_discount]
+            return self.ids[rows], self.discounts[rows]
+
+        # the price range is a slice of the price order
+        start = 0 if min_cents is None else int(np.searchsorted(self.prices_sorted, min_cents, "left"))
+        stop = len(self.ids) if max_cents is None else int(np.searchsorted(self.prices_sorted, max_cents, "right"))
+        rows = self.by_price[start:stop]
+        if min_discount is not None:
+            rows = rows[self.discounts[rows] >= min_discount]
+
+        if sort == "price":
+            rows = rows[:limit]
+            return self.ids[rows], self.prices[rows]
+
+        # top ``limit`` by discount without sorting the whole range, the id in the low
+        # bits of the key so ties at the cut are decided the same way as in SQL
+        keys = -self.discounts[rows].astype(np.int64) * 2**31 + self.ids[rows]
+        if len(rows) > limit:
+            top = np.argpartition(keys, limit - 1)[:limit]
+            rows, keys = rows[top], keys[top]
+        rows = rows[np.argsort(keys)]
+        return self.ids[rows], self.discounts[rows]
+
+
+class PriceIndex:
+    """Per category columns of id, price and discount for the deals queries, kept current from the change feed.
+
+    Loaded in the background after startup, until then queries go to the database.
+    """
+
+    def __init__(self, interval: float, enabled: bool = True):
+        self.interval = interval
+        self.enabled = enabled
+        self.partitions: Dict[str, Partition] = {}
+        self.ready = False
+        self.cursor = 0
+        self.loads = 0
+        self.refreshes = 0
+        self.changes_applied = 0
+        self.last_refresh_ms = 0.0
+        self._stopped = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def load(self):
+        if np is None:
+            # off the event loop, the first load runs while the first requests are served
+            await asyncio.to_thread(_import_numpy)
+        started = time.perf_counter()
+        # read first, changes made while loading are applied again by the next refresh
+        cursor = await latest_change()
+        columns = {}
+        last_id = 0
+        while True:
+            rows = await Product.filter(active = True, id__gt = last_id).order_by("id").limit(LOAD_CHUNK_SIZE) \
+                .values_list("id", "category", "new_price", "percentage_discount")
+            if not rows:
+                break
+            for id, category, price, discount in rows:
+                column = columns.setdefault(category, ([], [], []))
+                column[0].append(id)
+                column[1].append(to_cents(price))
+                column[2].append(discount)
+            last_id = rows[-1][0]
+
+        self.partitions = {category: Partition(*column) for category, column in columns.items()}
+        self.cursor = cursor
+        self.ready = True
+        self.loads += 1
+        logger.info("Price index loaded %s products in %s categories in %.0f ms",
+                    sum(map(len, self.partitions.values())), len(self.partitions), (time.perf_counter() - started) * 1000)
+
+    async def refresh(self) -> int:
+        """Apply the change feed entries written since the last refresh, reloading if they were pruned."""
+        started = time.perf_counter()
+        applied = 0
+        while True:
+            changes = await ProductChange.filter(id__gt = self.cursor).order_by("id").limit(LOAD_CHUNK_SIZE) \
+                .values_list("id", "product_id")
+            if not changes:
+                break
+            if applied == 0 and changes[0][0] > self.cursor + 1:
+                oldest = await ProductChange.all().order_by("id").limit(1).values_list("id", flat = True)
+                if oldest and oldest[0] > self.cursor + 1:
+                    logger.warning("Price index fell behind the pruned change feed, reloading")
+                    await self.load()
+                    continue
+
+            changed = np.unique(np.array([product_id for _, product_id in changes], dtype = np.int32))
+            rows = await Product.filter(id__in = changed.tolist(), active = True) \
+                .values_list("id", "category", "new_price", "percentage_discount")
+            added = {}
+            for id, category, price, discount in rows:
+                added.setdefault(category, []).append((id, to_cents(price), discount))
+
+            partitions = dict(self.partitions)
+            for category, partition in self.partitions.items():
+                removed = changed[partition.contains(changed)]
+                if len(removed) or category in added:
+                    partitions[category] = partition.replace(removed, added.pop(category, []))
+            for category, new_rows in added.items():
+                partitions[category] = Partition(*zip(*new_rows))
+            self.partitions = {category: partition for category, partition in partitions.items() if len(partition)}
+
+            self.cursor = changes[-1][0]
+            applied += len(changes)
+            if len(changes) < LOAD_CHUNK_SIZE:
+                break
+
+        if applied:
+            self.refreshes += 1
+            self.changes_applied += applied
+            self.last_refresh_ms = (time.perf_counter() - started) * 1000
+        return applied
+
+    async def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if self.ready:
+                    await self.refresh()
+                else:
+                    await self.load()
+            except Exception as e:
+                # serve from the database and reload, rather than keep answering from a stale index
+                logger.error("Price index refresh failed, reloading: %s", e)
+                self.ready = False
+            try:
+                await asyncio.wait_for(self._stopped.wait(), timeout = self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def query(
+        self,
+        category: Optional[str],
+        min_price: Optional[Decimal],
+        max_price: Optional[Decimal],
+        min_discount: Optional[int],
+        sort: str,
+        limit: int
+    ) -> Optional[List[int]]:
+        """Product ids in ``sort`` order, or None while the index is not loaded."""
+        if not self.ready:
+            return None
+        min_cents = None if min_price is None else to_cents(min_price)
+        max_cents = None if max_price is None else to_cents(max_price)
+        if category is not None:
+            partition = self.partitions.get(category)
+            return partition.query(min_cents, max_cents, min_discount, sort, limit)[0].tolist() if partition else []
+
+        # every category's own top ``limit``, merged
+        results = [partition.query(min_cents, max_cents, min_discount, sort, limit) for partition in self.partitions.values()]
+        if not results:
+            return []
+        ids = np.concatenate([ids for ids, _ in results])
+        keys = np.concatenate([keys for _, keys in results]).astype(np.int64)
+        order = np.lexsort((ids, -keys if sort == "discount" else keys))[:limit]
+        return ids[order].tolist()
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "products": sum(map(len, self.partitions.values())),
+            "categories": len(self.partitions),
+            "bytes": sum(partition.nbytes for partition in self.partitions.values()),
+            "cursor": self.cursor,
+            "loads": self.loads,
+            "refreshes": self.refreshes,
+            "changes_applied": self.changes_applied,
+            "last_refresh_ms": round(self.last_refresh_ms, 2)
+        }
+
+
+price_index = PriceIndex(PRICE_INDEX_INTERVAL, PRICE_INDEX_ENABLED)
+
+
+async def find_deals(
+    category: Optional[str],
+    min_price: Optional[Decimal],
+    max_price: Optional[Decimal],
+    min_discount: Optional[int],
+    sort: str,
+    limit: int,
+    fields: List[str]
+) -> List[dict]:
+    """Biggest discounts (or lowest prices) matching the filters, ids from the index and rows from the database."""
+    ids = price_index.query(category, min_price, max_price, min_discount, sort, limit)
+    if ids is None:
+        # not loaded yet, or disabled: the same query in SQL
+        queryset = filter_products(category, min_price, max_price, min_discount)
+        if sort == "discount":
+            queryset = queryset.order_by("-percentage_discount", "id")
+        else:
+            queryset = queryset.annotate(price_order = RawSQL('CAST("new_price" AS DOUBLE PRECISION)')).order_by("price_order", "id")
+        return [serialize_row(row) for row in await queryset.limit(limit).values(*fields)]
+
+    rows = await Product.filter(id__in = ids).values(*fields) if ids else []
+    by_id = {row["id"]: serialize_row(row) for row in rows}
+    return [by_id[id] for id in ids if id in by_id]
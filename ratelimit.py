@@ -0,0 +1,222 @@
+from fastapi import HTTPException, Request, status
+from tortoise import connections
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dotenv import dotenv_values
+from typing import Iterable, Optional, Tuple
+from models import RateLimitBucket
+import importlib
+import math
+import time
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+config_credentials = dotenv_values(".env")
+
+RATE_LIMIT_ENABLED = (config_credentials.get("RATE_LIMIT_ENABLED") or "true").lower() in ("1", "true", "yes")
+# "memory", "database" for buckets shared by every worker, or "package.module:ClassName" of a RateLimitBackend
+RATE_LIMIT_BACKEND = config_credentials.get("RATE_LIMIT_BACKEND") or "memory"
+# buckets kept by the memory backend, the least recently used are dropped (which refills them)
+RATE_LIMIT_MAX_KEYS = int(config_credentials.get("RATE_LIMIT_MAX_KEYS") or 100000)
+# take the client address from X-Forwarded-For, only behind a proxy that sets it
+RATE_LIMIT_TRUST_PROXY = (config_credentials.get("RATE_LIMIT_TRUST_PROXY") or "false").lower() in ("1", "true", "yes")
+
+# "<burst>/<period>": a bucket holds <burst> tokens and refills that many per period, "" turns the rule off.
+# Every /token request from an address takes a token, failed logins take one from the username as well
+LOGIN_IP_LIMIT = config_credentials.get("LOGIN_IP_LIMIT", "20/minute")
+LOGIN_USER_LIMIT = config_credentials.get("LOGIN_USER_LIMIT", "5/minute")
+REGISTRATION_IP_LIMIT = config_credentials.get("REGISTRATION_IP_LIMIT", "5/hour")
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+Rate = Tuple[int, float]
+
+
+def parse_rate(rate: str) -> Optional[Rate]:
+    if not rate:
+        return None
+    burst, _, period = rate.partition("/")
+    if not burst.strip().isdigit() or int(burst) <= 0 or period.strip() not in PERIODS:
+        raise ValueError(f"Invalid rate limit {rate!r}, expected e.g. 20/minute")
+    return int(burst), float(PERIODS[period.strip()])
+
+
+class RateLimitBackend(ABC):
+    """Interface for token bucket stores.
+
+    ``acquire`` takes ``cost`` tokens from the bucket ``key`` sized by
+    ``rate`` (burst, period) and returns 0, or the seconds until enough
+    tokens are back if the bucket is short, in which case nothing is taken.
+    A cost of 0 only checks that one token is available. A shared
+    implementation must do the check and the take atomically.
+    """
+
+    @abstractmethod
+    async def acquire(self, key: str, rate: Rate, cost: int = 1) -> float:
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryBuckets(RateLimitBackend):
+    """Per process buckets, refilled lazily from the time they were last touched."""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self.evictions = 0
+        self._buckets = OrderedDict()   # key -> (tokens, updated)
+
+    async def acquire(self, key: str, rate: Rate, cost: int = 1) -> float:
+        burst, period = rate
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * burst / period)
+
+        needed = max(cost, 1)
+        wait = 0.0 if tokens >= needed else (needed - tokens) * period / burst
+        if not wait:
+            tokens -= cost
+
+        if tokens < burst:
+            # a full bucket is the same as no bucket
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last = False)
+                self.evictions += 1
+        return wait
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "buckets": len(self._buckets), "max_buckets": self.max_keys, "evictions": self.evictions}
+
+
+# a bucket is the time it will be full again: taking ``step`` seconds worth of tokens pushes it
+# forward, and it is allowed while it stays within ``slack`` of now. One statement, so two
+# workers cannot both take the last token
+SQLITE_ACQUIRE = """INSERT INTO rate_limit_bucket (key, full_at) VALUES (?1, ?2 + ?3)
+    ON CONFLICT (key) DO UPDATE SET full_at = MAX(rate_limit_bucket.full_at, ?2) + ?3
+    WHERE MAX(rate_limit_bucket.full_at, ?2) <= ?2 + ?4
+    RETURNING full_at"""
+POSTGRES_ACQUIRE = """INSERT INTO rate_limit_bucket (key, full_at) VALUES ($1, $2 + $3)
+    ON CONFLICT (key) DO UPDATE SET full_at = GREATEST(rate_limit_bucket.full_at, $2) + $3
+    WHERE GREATEST(rate_limit_bucket.full_at, $2) <= $2 + $4
+    RETURNING full_at"""
+
+
+class DatabaseBuckets(RateLimitBackend):
+    """Buckets in a table of the application database, the same limits whichever worker is hit.
+
+    Each acquire is one upsert, a rejected one reads the bucket again for the
+    wait. Full buckets are deleted about once per ``prune_interval`` seconds.
+    Times are wall clock, the workers' clocks are assumed to agree.
+    """
+
+    def __init__(self, prune_interval: float = 3600):
+        self.prune_interval = prune_interval
+        self.pruned = 0
+        self._next_prune = 0.0
+
+    async def acquire(self, key: str, rate: Rate, cost: int = 1) -> float:
+        burst, period = rate
+        now = time.time()
+        step = cost * period / burst
+        slack = (burst - max(cost, 1)) * period / burst
+        connection = connections.get("default")
+        postgres = connection.capabilities.dialect == "postgres"
+        _, rows = await connection.execute_query(POSTGRES_ACQUIRE if postgres else SQLITE_ACQUIRE, [key, now, step, slack])
+
+        if now >= self._next_prune:
+            self._next_prune = now + self.prune_interval
+            self.pruned += await RateLimitBucket.filter(full_at__lt = now).delete()
+        if rows:
+            return 0.0
+        full_at = await RateLimitBucket.filter(key = key).values_list("full_at", flat = True)
+        # refilled in the meantime, the next attempt goes through
+        return max(full_at[0] - now - slack, 0.001) if full_at else 0.001
+
+    def stats(self) -> dict:
+        return {"backend": "database", "pruned": self.pruned}
+
+
+def load_backend(name: str) -> RateLimitBackend:
+    if name == "memory":
+        return MemoryBuckets(RATE_LIMIT_MAX_KEYS)
+    if name == "database":
+        return DatabaseBuckets()
+    module, _, cls = name.partition(":")
+    logger.info("Using rate limit backend %s", name)
+    backend = getattr(importlib.import_module(module), cls)()
+    # fail at startup, not on the first login
+    if not isinstance(backend, RateLimitBackend):
+        raise TypeError(f"RATE_LIMIT_BACKEND {name!r} is not a RateLimitBackend")
+    return backend
+
+
+def client_address(request: Request) -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+class RateLimiter:
+    """Token bucket limits for the endpoints that are expensive to call: bcrypt on /token, SMTP on /registration."""
+
+    def __init__(self, backend: RateLimitBackend, enabled: bool = True):
+        self.backend = backend
+        self.enabled = enabled
+        self.login_ip = parse_rate(LOGIN_IP_LIMIT)
+        self.login_user = parse_rate(LOGIN_USER_LIMIT)
+        self.registration_ip = parse_rate(REGISTRATION_IP_LIMIT)
+        self.allowed = {"login": 0, "registration": 0}
+        self.rejected = {"login": 0, "registration": 0}
+
+    async def check(self, scope: str, rules: Iterable[Tuple[str, Optional[Rate], int]]):
+        """Raise 429 unless every (key, rate, cost) rule has tokens left."""
+        if not self.enabled:
+            return
+        for key, rate, cost in rules:
+            if rate is None:
+                continue
+            wait = await self.backend.acquire(f"{scope}:{key}", rate, cost)
+            if wait:
+                self.rejected[scope] += 1
+                logger.warning("Rate limit hit for %s %s", scope, key)
+                raise HTTPException(
+                    status_code = status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail = "Too many attempts, try again later",
+                    headers = {"Retry-After": str(math.ceil(wait))}
+                )
+        self.allowed[scope] += 1
+
+    async def check_login(self, request: Request, username: str):
+        # the username bucket is only checked here, failed_login charges it
+        await self.check("login", [
+            ("ip:" + client_address(request), self.login_ip, 1),
+            ("user:" + username.lower(), self.login_user, 0)
+        ])
+
+    async def failed_login(self, username: str):
+        # charged on failures only, successful logins never use up the username's budget
+        if self.enabled and self.login_user is not None:
+            await self.backend.acquire("login:user:" + username.lower(), self.login_user, 1)
+
+    async def check_registration(self, request: Request):
+        await self.check("registration", [("ip:" + client_address(request), self.registration_ip, 1)])
+
+    def stats(self) -> dict:
+        return {
+            **self.backend.stats(),
+            "enabled": self.enabled,
+            "login_allowed": self.allowed["login"],
+            "login_rejected": self.rejected["login"],
+            "registration_allowed": self.allowed["registration"],
+            "registration_rejected": self.rejected["registration"]
+        }
+
+
+rate_limiter = RateLimiter(load_backend(RATE_LIMIT_BACKEND), RATE_LIMIT_ENABLED)
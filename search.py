@@ -0,0 +1,203 @@
+from fastapi import HTTPException, status
+from tortoise import connections
+from typing import List, Optional
+from catalog import PRODUCT_FIELDS, serialize_row
+import re
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_SEARCH_RESULTS = 100
+
+# percentage_discount ranges reported as the "discount" facet
+DISCOUNT_BUCKETS = (
+    ("0-9", 0, 9),
+    ("10-24", 10, 24),
+    ("25-49", 25, 49),
+    ("50+", 50, 100),
+)
+
+# The index holds one document per product: its name plus its seller's
+# business_description. Triggers keep it in sync with every write to product
+# and business, including bulk inserts that skip the ORM signals.
+SQLITE_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+        name, business_description, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_search (rowid, name, business_description)
+        SELECT NEW.id, NEW.name, b.business_description FROM business b WHERE b.id = NEW.business_owner_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_update AFTER UPDATE OF name, business_owner_id ON product BEGIN
+        DELETE FROM product_search WHERE rowid = OLD.id;
+        INSERT INTO product_search (rowid, name, business_description)
+        SELECT NEW.id, NEW.name, b.business_description FROM business b WHERE b.id = NEW.business_owner_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_delete AFTER DELETE ON product BEGIN
+        DELETE FROM product_search WHERE rowid = OLD.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_business AFTER UPDATE OF business_description ON business BEGIN
+        DELETE FROM product_search WHERE rowid IN (SELECT id FROM product WHERE business_owner_id = NEW.id);
+        INSERT INTO product_search (rowid, name, business_description)
+        SELECT p.id, p.name, NEW.business_description FROM product p WHERE p.business_owner_id = NEW.id;
+    END""",
+]
+SQLITE_BACKFILL = """
+    INSERT INTO product_search (rowid, name, business_description)
+    SELECT p.id, p.name, b.business_description FROM product p JOIN business b ON b.id = p.business_owner_id
+    WHERE p.id NOT IN (SELECT rowid FROM product_search)
+"""
+
+POSTGRES_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS product_search (
+        product_id INT PRIMARY KEY REFERENCES product (id) ON DELETE CASCADE,
+        document TSVECTOR NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS product_search_document ON product_search USING GIN (document)",
+    """CREATE OR REPLACE FUNCTION product_search_refresh() RETURNS TRIGGER AS $$
+    BEGIN
+        INSERT INTO product_search (product_id, document)
+        SELECT NEW.id, setweight(to_tsvector('simple', NEW.name), 'A')
+            || setweight(to_tsvector('simple', coalesce(b.business_description, '')), 'B')
+        FROM business b WHERE b.id = NEW.business_owner_id
+        ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document;
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION product_search_business_refresh() RETURNS TRIGGER AS $$
+    BEGIN
+        UPDATE product_search s SET document = setweight(to_tsvector('simple', p.name), 'A')
+            || setweight(to_tsvector('simple', coalesce(NEW.business_description, '')), 'B')
+        FROM product p WHERE p.id = s.product_id AND p.business_owner_id = NEW.id;
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS product_search_write ON product",
+    """CREATE TRIGGER product_search_write AFTER INSERT OR UPDATE OF name, business_owner_id ON product
+        FOR EACH ROW EXECUTE FUNCTION product_search_refresh()""",
+    "DROP TRIGGER IF EXISTS product_search_business ON business",
+    """CREATE TRIGGER product_search_business AFTER UPDATE OF business_description ON business
+        FOR EACH ROW EXECUTE FUNCTION product_search_business_refresh()""",
+]
+POSTGRES_BACKFILL = """
+    INSERT INTO product_search (product_id, document)
+    SELECT p.id, setweight(to_tsvector('simple', p.name), 'A')
+        || setweight(to_tsvector('simple', coalesce(b.business_description, '')), 'B')
+    FROM product p JOIN business b ON b.id = p.business_owner_id
+    ON CONFLICT (product_id) DO NOTHING
+"""
+
+
+def _dialect() -> str:
+    return connections.get("default").capabilities.dialect
+
+
+async def ensure_search_index():
+    # idempotent, part of "python database.py migrate"
+    connection = connections.get("default")
+    postgres = _dialect() == "postgres"
+    for statement in POSTGRES_SCHEMA if postgres else SQLITE_SCHEMA:
+        await connection.execute_script(statement)
+    await connection.execute_script(POSTGRES_BACKFILL if postgres else SQLITE_BACKFILL)
+    logger.info("Product search index up to date")
+
+
+def _terms(q: str) -> List[str]:
+    terms = re.findall(r"\w+", q.lower())
+    if not terms:
+        raise HTTPException(
+            status_code = status.HTTP_400_BAD_REQUEST,
+            detail = "Search query must contain at least one word"
+        )
+    return terms[:10]
+
+
+class _Query:
+    """Collects SQL conditions with dialect specific placeholders."""
+
+    def __init__(self, postgres: bool):
+        self.postgres = postgres
+        self.conditions = []
+        self.params = []
+
+    def add(self, condition: str, *values):
+        for value in values:
+            self.params.append(value)
+            placeholder = f"${len(self.params)}" if self.postgres else "?"
+            condition = condition.replace("{}", placeholder, 1)
+        self.conditions.append(condition)
+
+    @property
+    def where(self) -> str:
+        return " AND ".join(self.conditions)
+
+
+async def search_products(
+    q: str,
+    category: Optional[str] = None,
+    city: Optional[str] = None,
+    region: Optional[str] = None,
+    min_discount: Optional[int] = None,
+    limit: int = 20,
+    offset: int = 0
+) -> dict:
+    """Ranked prefix search over product names and business descriptions, with facet counts."""
+    connection = connections.get("default")
+    postgres = _dialect() == "postgres"
+    terms = _terms(q)
+
+    query = _Query(postgres)
+    if postgres:
+        source = "product_search s JOIN product p ON p.id = s.product_id"
+        query.add("s.document @@ to_tsquery('simple', {})", " & ".join(f"{term}:*" for term in terms))
+        # ranked by the same tsquery, reusing the match parameter
+        rank = f"ts_rank(s.document, to_tsquery('simple', ${len(query.params)})) DESC"
+    else:
+        source = "product_search s JOIN product p ON p.id = s.rowid"
+        query.add("product_search MATCH {}", " ".join(f'"{term}"*' for term in terms))
+        rank = "bm25(product_search, 10.0, 1.0)"
+    source += " JOIN business b ON b.id = p.business_owner_id"
+    query.add("p.active = {}", True)
+
+    if category is not None:
+        query.add("p.category = {}", category)
+    if city is not None:
+        query.add("b.city = {}", city)
+    if region is not None:
+        query.add("b.region = {}", region)
+    if min_discount is not None:
+        query.add("p.percentage_discount >= {}", min_discount)
+
+    columns = ", ".join(f"p.{field}" for field in PRODUCT_FIELDS)
+    rows = await connection.execute_query_dict(
+        f"SELECT {columns}, b.business_name, b.city, b.region FROM {source} "
+        f"WHERE {query.where} ORDER BY {rank} LIMIT {int(limit)} OFFSET {int(offset)}",
+        query.params
+    )
+
+    bucket = "CASE " + " ".join(
+        f"WHEN p.percentage_discount BETWEEN {low} AND {high} THEN '{name}'" for name, low, high in DISCOUNT_BUCKETS
+    ) + " ELSE 'other' END"
+    facets = {}
+    for facet, expression in (("category", "p.category"), ("city", "b.city"), ("region", "b.region"), ("discount", bucket)):
+        counts = await connection.execute_query_dict(
+            f"SELECT {expression} AS value, COUNT(*) AS count FROM {source} WHERE {query.where} "
+            f"GROUP BY {expression} ORDER BY count DESC",
+            query.params
+        )
+        facets[facet] = {row["value"]: row["count"] for row in counts}
+
+    results = []
+    for row in rows:
+        product = serialize_row({field: row[field] for field in PRODUCT_FIELDS})
+        # raw rows, SQLite returns the flag as 0/1
+        product["active"] = bool(product["active"])
+        product["business"] = {"name": row["business_name"], "city": row["city"], "region": row["region"]}
+        results.append(product)
+
+    return {
+        "status": "ok",
+        "data": results,
+        "total": sum(facets["category"].values()),
+        "facets": facets
+    }
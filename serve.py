@@ -0,0 +1,170 @@
+"""Pre-forking multi-process server.
+
+    python serve.py --workers 4 --host 0.0.0.0 --port 8000
+
+The supervisor migrates the schema once, imports the app (models, pydantic
+schemas and templates are built here and shared copy-on-write), binds the
+listening socket and forks the workers, which all accept on it. Workers that
+die are replaced. SIGTERM or SIGINT lets every worker finish its requests,
+drain the email outbox and hand over its queued log records, after which the
+supervisor writes out the log and exits.
+
+Each worker has its own response cache, user cache and metrics; /metrics and
+/stats describe the worker that answered. Response caches follow the product
+and business change feed, so writes made through one worker reach the others
+within CHANGE_POLL_INTERVAL.
+"""
+from dotenv import dotenv_values
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+config_credentials = dotenv_values(".env")
+
+WEB_WORKERS = int(config_credentials.get("WEB_WORKERS") or os.cpu_count() or 1)
+# seconds a worker gets to finish in-flight requests and drain its queues on shutdown
+GRACEFUL_TIMEOUT = float(config_credentials.get("GRACEFUL_TIMEOUT") or 30)
+# a worker that dies sooner than this after starting is not restarted in a loop
+MIN_WORKER_LIFETIME = 5
+
+
+def size_pools(workers: int):
+    # the bcrypt and image pools are per worker, split the cores unless they were set explicitly
+    import authentication
+    import images
+
+    share = max(1, (os.cpu_count() or 1) // workers)
+    if not config_credentials.get("HASH_WORKERS"):
+        authentication.hash_pool.workers = min(authentication.hash_pool.workers, share)
+    if not config_credentials.get("IMAGE_WORKERS"):
+        images.image_pipeline.workers = share
+
+
+def preload(app_module):
+    # main defers its heavy imports to first use, which would make each worker pay for
+    # them on its first email, login, import or upload. Done before forking they are shared
+    import authentication
+    import mail
+
+    mail.mail_config()
+    authentication.pwd_context()
+    app_module.get_templates()
+    import numpy
+    import PIL.Image
+
+
+class Supervisor:
+    def __init__(self, config, workers: int):
+        self.config = config
+        self.workers = workers
+        self.socket = None
+        self.children = {}  # pid -> start time
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+        # worker
+        import logs
+        import uvicorn
+
+        logs.forget_writer()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        try:
+            uvicorn.Server(self.config).run(sockets = [self.socket])
+        finally:
+            logs.stop_logging()
+            os._exit(0)
+
+    def stop(self, signum, frame):
+        if not self.stopping:
+            logger.info("Received signal %s, stopping %s worker(s)", signum, len(self.children))
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        self.socket = self.config.bind_socket()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        logger.info("Serving on %s:%s with %s worker(s)", self.config.host, self.config.port, self.workers)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            logger.error("Worker %s exited with status %s", pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                # crashing on startup, replacing it would only spin
+                self.stop(signal.SIGTERM, None)
+                continue
+            self.spawn()
+
+
+def serve(args):
+    import database
+
+    if args.db_url:
+        database.TORTOISE_ORM.clear()
+        database.TORTOISE_ORM.update(database.build_tortoise_config(args.db_url))
+    if not args.no_migrate:
+        from tortoise import run_async
+        run_async(database.migrate())
+    # the schema is ready, keep the workers from generating it concurrently
+    database.GENERATE_SCHEMAS = False
+
+    import uvicorn
+    import logs
+    import main as app_module
+
+    # one writer for all workers: records travel over a process queue to this process
+    logs.stop_logging()
+    log_queue = multiprocessing.Queue(logs.LOG_QUEUE_SIZE)
+    logs.start_writer(log_queue)
+    logs.setup_logging(log_queue)
+
+    preload(app_module)
+    size_pools(args.workers)
+    config = uvicorn.Config(
+        app_module.app,
+        host = args.host,
+        port = args.port,
+        timeout_graceful_shutdown = GRACEFUL_TIMEOUT,
+        access_log = args.access_log,
+        log_level = args.log_level
+    )
+    Supervisor(config, args.workers).run()
+    logs.stop_logging()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--workers", type = int, default = WEB_WORKERS)
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8000)
+    parser.add_argument("--db-url", help = "override DB_URL from .env")
+    parser.add_argument("--no-migrate", action = "store_true", help = "skip the schema migration before forking")
+    parser.add_argument("--access-log", action = "store_true", help = "print uvicorn's access log to stdout")
+    parser.add_argument("--log-level", default = "info", help = "uvicorn's own console output")
+    sys.exit(serve(parser.parse_args()))
@@ -0,0 +1,112 @@
+"""Local SMTP stand-in for tests and benchmarks.
+
+Accepts every message and keeps it in memory instead of delivering it.
+Run it next to the app with MAIL_SERVER=localhost, MAIL_PORT=1025,
+MAIL_STARTTLS=false and USE_CREDENTIALS=false in .env:
+
+    python smtp_stub.py --port 1025
+"""
+from typing import List, Optional
+import argparse
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPStub:
+    def __init__(self, host: str = "127.0.0.1", port: int = 1025, delay: float = 0):
+        self.host = host
+        self.port = port
+        # simulated per message latency of a real relay
+        self.delay = delay
+        self.messages: List[dict] = []
+        self.connections = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("SMTP stub listening on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+
+        async def reply(line: str):
+            writer.write((line + "\r\n").encode())
+            await writer.drain()
+
+        await reply("220 smtp-stub ready")
+        sender, recipients = None, []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors = "replace").strip()
+                verb = command[:4].upper()
+
+                if verb == "EHLO":
+                    await reply("250-smtp-stub")
+                    await reply("250-8BITMIME")
+                    await reply("250 SMTPUTF8")
+                elif verb == "HELO":
+                    await reply("250 smtp-stub")
+                elif verb == "MAIL":
+                    sender, recipients = command.split(":", 1)[1].strip(), []
+                    await reply("250 OK")
+                elif verb == "RCPT":
+                    recipients.append(command.split(":", 1)[1].strip())
+                    await reply("250 OK")
+                elif verb == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    data = []
+                    while True:
+                        chunk = await reader.readline()
+                        if chunk in (b".\r\n", b".\n", b""):
+                            break
+                        data.append(chunk)
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    self.messages.append({
+                        "sender": sender,
+                        "recipients": recipients,
+                        "data": b"".join(data).decode(errors = "replace")
+                    })
+                    await reply("250 OK queued")
+                elif verb in ("RSET", "NOOP"):
+                    await reply("250 OK")
+                elif verb == "QUIT":
+                    await reply("221 Bye")
+                    break
+                else:
+                    await reply("502 Command not implemented")
+        finally:
+            writer.close()
+
+
+async def main(host: str, port: int, delay: float):
+    stub = SMTPStub(host, port, delay)
+    await stub.start()
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logger.info("%s message(s) received over %s connection(s)", len(stub.messages), stub.connections)
+    finally:
+        await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Local SMTP server that accepts and discards mail")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 1025)
+    parser.add_argument("--delay", type = float, default = 0, help = "seconds to wait before accepting each message")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main(args.host, args.port, args.delay))
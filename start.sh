@@ -9,5 +9,5 @@ echo "🚀 FastAPI app starting..." | tee -a $LOGFILE
 echo "🌐 Visit: http://localhost:8000" | tee -a $LOGFILE
 echo "" | tee -a $LOGFILE
 
-# Start FastAPI with logging
-uvicorn main:app --host 0.0.0.0 --port 8000 | tee -a $LOGFILE
+# Migrates the schema once, then forks one worker per core (WEB_WORKERS in .env to override)
+python serve.py --host 0.0.0.0 --port 8000 2>&1 | tee -a $LOGFILE